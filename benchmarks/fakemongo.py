@@ -0,0 +1,304 @@
+"""
+In memory stand-in for the subset of AsyncIOMotorClient used by the server,
+so that the API can be driven without a MongoDB server.
+"""
+import copy
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+
+def _get(doc: dict, field: str):
+    value = doc
+    for part in field.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def _compare(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+        for op, operand in condition.items():
+            if op == "$in":
+                if value not in operand:
+                    return False
+            elif op == "$ne":
+                if value == operand:
+                    return False
+            elif value is None:
+                return False
+            elif op == "$gt" and not value > operand:
+                return False
+            elif op == "$gte" and not value >= operand:
+                return False
+            elif op == "$lt" and not value < operand:
+                return False
+            elif op == "$lte" and not value <= operand:
+                return False
+        return True
+    return value == condition
+
+
+def matches(doc: dict, query: dict) -> bool:
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(doc, sub_query) for sub_query in condition):
+                return False
+        elif not _compare(_get(doc, field), condition):
+            return False
+    return True
+
+
+def _project(doc: dict, projection) -> dict:
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include = {field for field, value in projection.items() if value and field != "_id"}
+    if include:
+        projected = {field: doc[field] for field in include if field in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            projected["_id"] = doc["_id"]
+        return projected
+    return {field: value for field, value in doc.items() if projection.get(field, 1)}
+
+
+class FakeResult:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeCursor:
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self._sort = None
+        self._limit = 0
+
+    def sort(self, key, direction=1):
+        self._sort = [(key, direction)] if isinstance(key, str) else list(key)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def _docs(self):
+        docs = [doc for doc in self.collection.docs if matches(doc, self.query)]
+        for key, direction in reversed(self._sort or []):
+            docs.sort(key=lambda doc: _get(doc, key), reverse=direction < 0)
+        if self._limit:
+            docs = docs[:self._limit]
+        return [_project(doc, self.projection) for doc in docs]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._docs():
+            yield doc
+
+    async def to_list(self, length=None):
+        docs = self._docs()
+        return docs[:length] if length else docs
+
+
+class FakeCollection:
+    def __init__(self, name):
+        self.name = name
+        self.docs = []
+        self.indexes = {"_id_": {"name": "_id_", "key": {"_id": 1}}}
+        self.unique = {}  # field: {value: doc}
+
+    def _lookup(self, query: dict):
+        for field, index in self.unique.items():
+            value = query.get(field)
+            if value is not None and not isinstance(value, dict):
+                doc = index.get(value)
+                return [doc] if doc is not None and matches(doc, query) else []
+        return [doc for doc in self.docs if matches(doc, query)]
+
+    def _check_unique(self, doc: dict, ignore=None):
+        for field, index in self.unique.items():
+            other = index.get(doc.get(field))
+            if other is not None and other is not ignore:
+                raise DuplicateKeyError(f"E11000 duplicate key error {field}: {doc.get(field)}", 11000)
+
+    def _index(self, doc: dict):
+        for field, index in self.unique.items():
+            if field in doc:
+                index[doc[field]] = doc
+
+    def _unindex(self, doc: dict):
+        for field, index in self.unique.items():
+            if index.get(doc.get(field)) is doc:
+                del index[doc[field]]
+
+    def _insert(self, doc: dict):
+        doc.setdefault("_id", ObjectId())
+        stored = copy.deepcopy(doc)
+        self._check_unique(stored)
+        self.docs.append(stored)
+        self._index(stored)
+        return stored["_id"]
+
+    def _apply(self, doc: dict, update: dict):
+        updated = copy.deepcopy(doc)
+        for field, value in update.get("$set", {}).items():
+            updated[field] = copy.deepcopy(value)
+        for field, value in update.get("$inc", {}).items():
+            updated[field] = updated.get(field, 0) + value
+        for field in update.get("$unset", {}):
+            updated.pop(field, None)
+        self._check_unique(updated, ignore=doc)
+        self._unindex(doc)
+        doc.clear()
+        doc.update(updated)
+        self._index(doc)
+
+    def _upsert(self, query: dict, update: dict) -> dict:
+        doc = {field: value for field, value in query.items()
+               if not field.startswith("$") and not isinstance(value, dict)}
+        self._insert(doc)
+        stored = self.docs[-1]
+        self._apply(stored, update)
+        return stored
+
+    async def find_one(self, query=None, projection=None, **kwargs):
+        docs = self._lookup(query or {})
+        return _project(docs[0], projection) if docs else None
+
+    def find(self, query=None, projection=None, batch_size=None, **kwargs):
+        return FakeCursor(self, query or {}, projection)
+
+    async def insert_one(self, doc):
+        return FakeResult(inserted_id=self._insert(doc))
+
+    async def insert_many(self, docs, ordered=True):
+        inserted, errors = [], []
+        for i, doc in enumerate(docs):
+            try:
+                inserted.append(self._insert(doc))
+            except DuplicateKeyError as e:
+                errors.append({"index": i, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(inserted)})
+        return FakeResult(inserted_ids=inserted)
+
+    async def update_one(self, query, update, upsert=False):
+        docs = self._lookup(query)
+        if docs:
+            self._apply(docs[0], update)
+            return FakeResult(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            return FakeResult(matched_count=0, modified_count=0,
+                              upserted_id=self._upsert(query, update)["_id"])
+        return FakeResult(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def find_one_and_update(self, query, update, projection=None, sort=None,
+                                  upsert=False, return_document=ReturnDocument.BEFORE):
+        docs = self._lookup(query)
+        for key, direction in reversed(sort or []):
+            docs.sort(key=lambda doc: _get(doc, key), reverse=direction < 0)
+        if not docs:
+            if not upsert:
+                return None
+            doc = self._upsert(query, update)
+            return _project(doc, projection) if return_document == ReturnDocument.AFTER else None
+
+        doc = docs[0]
+        before = _project(doc, projection)
+        self._apply(doc, update)
+        return _project(doc, projection) if return_document == ReturnDocument.AFTER else before
+
+    async def delete_one(self, query):
+        docs = self._lookup(query)
+        if docs:
+            self._unindex(docs[0])
+            self.docs.remove(docs[0])
+        return FakeResult(deleted_count=len(docs[:1]))
+
+    async def bulk_write(self, requests, ordered=True):
+        matched = modified = 0
+        for request in requests:
+            result = await self.update_one(request._filter, request._doc, upsert=request._upsert)
+            matched += result.matched_count
+            modified += result.modified_count
+        return FakeResult(matched_count=matched, modified_count=modified)
+
+    async def count_documents(self, query, **kwargs):
+        count = len(self._lookup(query))
+        if "limit" not in kwargs:
+            return count
+        if kwargs["limit"] <= 0:
+            # pymongo sends the limit as a $limit stage
+            raise OperationFailure("the limit must be positive", code=15958)
+        return min(count, kwargs["limit"])
+
+    async def estimated_document_count(self):
+        return len(self.docs)
+
+    async def create_indexes(self, indexes):
+        for index in indexes:
+            document = index.document
+            self.indexes[document["name"]] = document
+            keys = list(document["key"])
+            if document.get("unique") and len(keys) == 1:
+                self.unique[keys[0]] = {doc[keys[0]]: doc for doc in self.docs if keys[0] in doc}
+        return [index.document["name"] for index in indexes]
+
+    def list_indexes(self):
+        async def iterate():
+            for index in list(self.indexes.values()):
+                yield index
+        return iterate()
+
+    def watch(self, *args, **kwargs):
+        raise OperationFailure(
+            "The $changeStream stage is only supported on replica sets", 40573
+        )
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(name)
+        return self.collections[name]
+
+    async def command(self, command, *args, **kwargs):
+        if command in ("ping", "ismaster", "isMaster", "hello"):
+            return {"ok": 1.0, "localTime": datetime.utcnow()}
+        raise OperationFailure(f"no such command: {command}", 59)
+
+
+class FakeClient:
+    """Stand-in for AsyncIOMotorClient, `client[db][collection]` returns an in memory collection
+    """
+
+    def __init__(self):
+        self.databases = {}
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = FakeDatabase()
+        return self.databases[name]
+
+    @property
+    def admin(self):
+        return self["admin"]
+
+    def close(self):
+        pass
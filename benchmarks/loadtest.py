@@ -0,0 +1,394 @@
+"""
+End-to-end load test of the API.
+
+The app runs against the in memory Mongo stand-in of benchmarks.fakemongo,
+seeded with N users, either driven in process through ASGI or served by a
+local uvicorn in a separate process. Results are printed as JSON so that
+runs can be compared.
+
+    python -m benchmarks.loadtest --sizes 100,1000,10000 --requests 2000 --concurrency 32
+    python -m benchmarks.loadtest --server uvicorn --output results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from urllib.parse import urlencode
+
+from benchmarks.fakemongo import FakeClient
+
+ADMIN_EMAIL = "admin@example.com"
+USER_EMAIL = "user@example.com"
+
+
+async def seed(client: FakeClient, size: int) -> dict:
+    """Seed the users collection with `size` active users, among which
+    a superuser and a regular user
+    :return: dict of the api key of ADMIN_EMAIL and USER_EMAIL
+    """
+    from server.core.bloom import email_filter
+    from server.core.settings import mongo_db
+    from server.db.crud.user import create_api_users, mongo_collection
+    from server.db.mongodb import ensure_indexes
+    from server.models.user import BaseUserCreate
+
+    await ensure_indexes(client)
+    admin_key, user_key = await create_api_users(client, [
+        (BaseUserCreate(email=ADMIN_EMAIL), True, None),
+        (BaseUserCreate(email=USER_EMAIL), False, None),
+    ])
+    batch = 1000
+    for start in range(0, max(size - 2, 0), batch):
+        await create_api_users(client, [
+            (BaseUserCreate(email=f"user{i}@example.com"), False, None)
+            for i in range(start, min(start + batch, size - 2))
+        ])
+    for doc in client[mongo_db][mongo_collection].docs:
+        doc["is_active"] = True
+    await email_filter.load(client)
+
+    return {ADMIN_EMAIL: admin_key, USER_EMAIL: user_key}
+
+
+def install(client: FakeClient):
+    """Make the app use `client` and start from empty in process state
+    """
+    from server.core.cache import auth_cache
+    from server.db.mongodb import db
+
+    db.client = client
+    auth_cache.invalidate()
+
+
+def _auth(keys: dict, email: str) -> dict:
+    return {"x-email-id": email, "x-api-key": keys[email]}
+
+
+def scenarios(keys: dict) -> dict:
+    """Request factories of each scenario, called with the request number
+    :return: dict of scenario name: function(i) -> (method, path, headers, body)
+    """
+    run_id = int(time.time() * 1000)
+    form = {"content-type": "application/x-www-form-urlencoded"}
+    return {
+        "hello": lambda i: ("GET", "/api/hello/", _auth(keys, USER_EMAIL), b""),
+        "list_users": lambda i: ("GET", "/api/user/", _auth(keys, ADMIN_EMAIL), b""),
+        "create_user": lambda i: (
+            "POST", "/api/user/new", {**_auth(keys, ADMIN_EMAIL), **form},
+            urlencode({
+                "user_email": f"new{run_id}-{i}@example.com",
+                "is_superuser": "false",
+                "access": "user"
+            }).encode()
+        ),
+    }
+
+
+class ASGITransport:
+    """Sends requests straight to an ASGI app, in process
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, path: str, headers: dict, body: bytes) -> int:
+        path, _, query = path.partition("?")
+        scope = {
+            "type": "http",
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+            "client": ("127.0.0.1", 50000),
+            "server": ("127.0.0.1", 80),
+        }
+        body_sent = False
+        disconnected = asyncio.Event()
+        status = 0
+
+        async def receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            disconnected.set()
+        return status
+
+    async def close(self):
+        pass
+
+
+class HTTPConnection:
+    """Minimal keep-alive HTTP/1.1 client
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method: str, path: str, headers: dict, body: bytes) -> int:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}",
+                 f"Content-Length: {len(body)}"]
+        lines.extend(f"{k}: {v}" for k, v in headers.items())
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+
+        status = int((await self.reader.readline()).split()[1])
+        response_headers = {}
+        while True:
+            line = (await self.reader.readline()).decode().strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            response_headers[name.lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding") == "chunked":
+            while True:
+                length = int((await self.reader.readline()).strip(), 16)
+                await self.reader.readexactly(length + 2)
+                if length == 0:
+                    break
+        else:
+            await self.reader.readexactly(int(response_headers.get("content-length", 0)))
+
+        if response_headers.get("connection") == "close":
+            await self.close()
+        return status
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+async def run_scenario(new_transport, make_request, requests: int, concurrency: int,
+                       warmup: int) -> dict:
+    """Send `requests` requests from `concurrency` concurrent clients
+    :return: dict of the throughput, latency and statuses of the run
+    """
+    latencies = []
+    statuses = {}
+    errors = 0
+    counter = iter(range(warmup + requests))
+
+    async def client():
+        nonlocal errors
+        transport = new_transport()
+        try:
+            for i in counter:
+                method, path, headers, body = make_request(i)
+                start = time.perf_counter()
+                try:
+                    status = await transport.request(method, path, headers, body)
+                except Exception:
+                    status = 0
+                    await transport.close()
+                    transport = new_transport()
+                elapsed = time.perf_counter() - start
+                if i < warmup:
+                    continue
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+                if not 200 <= status < 400:
+                    errors += 1
+        finally:
+            await transport.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    recorded = len(latencies)
+    return {
+        "requests": recorded,
+        "concurrency": concurrency,
+        "errors": errors,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "duration_s": round(duration, 4),
+        "rps": round(recorded / duration, 2) if duration else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / recorded * 1000, 3) if recorded else 0.0,
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+    }
+
+
+async def _serve(port: int, size: int, keys_queue):
+    import uvicorn
+    from server.main import app
+
+    client = FakeClient()
+    keys = await seed(client, size)
+    install(client)
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, lifespan="off",
+                            log_level="warning", access_log=False)
+    server = uvicorn.Server(config)
+    keys_queue.put(keys)
+    await server.serve()
+
+
+def serve(port: int, size: int, keys_queue):
+    """Child process entry point: seed a stand-in and serve the app with uvicorn
+    """
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(_serve(port, size, keys_queue))
+
+
+async def _wait_for_port(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def run_size(args, size: int) -> list:
+    if args.server == "uvicorn":
+        context = multiprocessing.get_context("spawn")
+        keys_queue = context.Queue()
+        process = context.Process(target=serve, args=(args.port, size, keys_queue), daemon=True)
+        process.start()
+        try:
+            keys = keys_queue.get(timeout=600)
+            await _wait_for_port(args.port)
+            return await _run_all(args, size, keys, lambda: HTTPConnection("127.0.0.1", args.port))
+        finally:
+            process.terminate()
+            process.join()
+
+    from server.main import app
+
+    client = FakeClient()
+    keys = await seed(client, size)
+    install(client)
+    transport = ASGITransport(app)
+    return await _run_all(args, size, keys, lambda: transport)
+
+
+async def _run_all(args, size: int, keys: dict, new_transport) -> list:
+    results = []
+    factories = scenarios(keys)
+    for name in args.scenarios:
+        make_request = factories[name]
+        if args.gzip:
+            make_request = _with_gzip(make_request)
+        result = await run_scenario(
+            new_transport, make_request, args.requests, args.concurrency, args.warmup
+        )
+        results.append({"scenario": name, "collection_size": size, **result})
+        print(
+            f"{name:<12} size={size:<8} rps={result['rps']:<10} "
+            f"p50={result['latency_ms']['p50']}ms p95={result['latency_ms']['p95']}ms "
+            f"p99={result['latency_ms']['p99']}ms errors={result['errors']}",
+            file=sys.stderr
+        )
+    return results
+
+
+def _with_gzip(make_request):
+    def request(i):
+        method, path, headers, body = make_request(i)
+        return method, path, {**headers, "accept-encoding": "gzip"}, body
+    return request
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+async def main(args) -> dict:
+    results = []
+    for size in args.sizes:
+        results.extend(await run_size(args, size))
+    return {
+        "meta": {
+            "date": datetime.utcnow().isoformat() + "Z",
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "server": args.server,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "warmup": args.warmup,
+            "gzip": args.gzip,
+        },
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--server", choices=("inprocess", "uvicorn"), default="inprocess")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--sizes", default="100,1000,10000",
+                        help="comma separated numbers of seeded users")
+    parser.add_argument("--scenarios", default="hello,list_users,create_user",
+                        help="comma separated scenarios")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--warmup", type=int, default=50, help="unrecorded requests per scenario")
+    parser.add_argument("--no-gzip", dest="gzip", action="store_false",
+                        help="do not send accept-encoding: gzip")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args(argv)
+    args.sizes = [int(size) for size in args.sizes.split(",")]
+    args.scenarios = args.scenarios.split(",")
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    arguments = parse_args()
+    report = json.dumps(asyncio.run(main(arguments)), indent=2)
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
@@ -0,0 +1,327 @@
+"""
+Micro-benchmarks of the security, model and CRUD hot paths.
+
+Each benchmark is timed with timeit (best of --repeat runs) and its
+allocations are traced with tracemalloc. Results are compared against a
+stored baseline and a benchmark slower than the baseline by more than
+--tolerance is reported as a regression.
+
+    python -m benchmarks.micro
+    python -m benchmarks.micro --filter model --save-baseline
+    python -m benchmarks.micro --check  # exit with 1 on regressions
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import platform
+import re
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime
+
+from benchmarks.fakemongo import FakeClient
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+BCRYPT_ROUNDS = (4, 8, 10, 12)
+LIST_PAGE_SIZE = 100
+
+benchmarks = {}
+
+
+def benchmark(name: str):
+    """Register a benchmark, the decorated function does the setup and
+    returns the callable to time
+    """
+    def register(setup):
+        benchmarks[name] = setup
+        return setup
+    return register
+
+
+def _row() -> dict:
+    from server.models.user import BaseUserInDB
+
+    user = BaseUserInDB(email="user@example.com", is_active=True)
+    user.reset_api_key("k" * 43)
+    row = user.dict()
+    row["_id"] = "5dbb5a4e3f8a4b2d9c1e7f00"
+    row["created_at"] = row["updated_at"] = datetime.utcnow()
+    return row
+
+
+SALTED_KEY = "salt" + "k" * 43
+
+
+def _use_scheme(scheme: str, rounds: int = None):
+    """Configure the hashing of the security module for the benchmark about to run
+    """
+    from server.core import security
+
+    security.API_KEY_HASH_SCHEME = scheme
+    if rounds is not None:
+        security.apikey_context = security.apikey_context.copy(bcrypt__rounds=rounds)
+    return security
+
+
+for _rounds in BCRYPT_ROUNDS:
+    def _setup_hash(rounds=_rounds):
+        security = _use_scheme("bcrypt", rounds)
+        return lambda: security.get_key_hash(SALTED_KEY)
+
+    def _setup_verify(rounds=_rounds):
+        security = _use_scheme("bcrypt", rounds)
+        hashed = security.get_key_hash(SALTED_KEY)
+        return lambda: security.verify_key(SALTED_KEY, hashed)
+
+    benchmark(f"security.get_key_hash[bcrypt-{_rounds}]")(_setup_hash)
+    benchmark(f"security.verify_key[bcrypt-{_rounds}]")(_setup_verify)
+
+
+@benchmark("security.get_key_hash[hmac]")
+def setup_hmac_hash():
+    security = _use_scheme("hmac")
+    return lambda: security.get_key_hash(SALTED_KEY)
+
+
+@benchmark("security.verify_key[hmac]")
+def setup_hmac_verify():
+    security = _use_scheme("hmac")
+    hashed = security.get_key_hash(SALTED_KEY)
+    return lambda: security.verify_key(SALTED_KEY, hashed)
+
+
+@benchmark("model.BaseUserInDB(**row)")
+def setup_model_validated():
+    from server.models.user import BaseUserInDB
+
+    row = _row()
+    return lambda: BaseUserInDB(**row)
+
+
+@benchmark("model.BaseUserInDB.construct(row)")
+def setup_model_construct():
+    from server.models.user import BaseUserInDB
+
+    row = _row()
+    fields = set(BaseUserInDB.__fields__)
+    values = {k: v for k, v in row.items() if k in fields}
+    if "_fields_set" in inspect.signature(BaseUserInDB.construct).parameters:
+        # pydantic 1.x
+        return lambda: BaseUserInDB.construct(set(row) & fields, **values)
+    return lambda: BaseUserInDB.construct(values, set(row) & fields)
+
+
+@benchmark("model.BaseUserInDB.from_db(row)")
+def setup_model_from_db():
+    from server.models.user import BaseUserInDB
+
+    row = _row()
+    return lambda: BaseUserInDB.from_db(row)
+
+
+@benchmark("model.User(**user.dict())")
+def setup_model_round_trip():
+    from server.models.user import BaseUserInDB, User
+
+    user = BaseUserInDB(**_row())
+    return lambda: User(**user.dict())
+
+
+@benchmark("model.User.from_db(user)")
+def setup_model_from_model():
+    from server.models.user import BaseUserInDB, User
+
+    user = BaseUserInDB.from_db(_row())
+    return lambda: User.from_db(user.__dict__)
+
+
+def _page() -> dict:
+    from server.models.user import BaseUser
+
+    now = datetime.utcnow()
+    return {
+        "total_users": LIST_PAGE_SIZE,
+        "users": [
+            BaseUser(email=f"user{i}@example.com", created_at=now, updated_at=now).dict()
+            for i in range(LIST_PAGE_SIZE)
+        ],
+        "next_cursor": "5dbb5a4e3f8a4b2d9c1e7f00",
+    }
+
+
+@benchmark(f"json.get_all[{LIST_PAGE_SIZE}] jsonable_encoder")
+def setup_json_jsonable():
+    from fastapi.encoders import jsonable_encoder
+
+    page = _page()
+    return lambda: json.dumps(jsonable_encoder(page)).encode()
+
+
+@benchmark(f"json.get_all[{LIST_PAGE_SIZE}] RWModel encoder")
+def setup_json_rwmodel():
+    from server.models.user import RWModel
+
+    page = _page()
+    encoder = RWModel.__config__.json_encoders[datetime]
+    return lambda: json.dumps(page, default=encoder).encode()
+
+
+@benchmark(f"json.get_all[{LIST_PAGE_SIZE}] FastJSONResponse")
+def setup_json_fast():
+    from server.core.responses import FastJSONResponse
+
+    page = _page()
+    return lambda: FastJSONResponse(page).body
+
+
+@benchmark(f"crud.get_all[{LIST_PAGE_SIZE}]")
+def setup_crud_get_all():
+    from server.db.crud.user import create_api_users, get_all
+    from server.models.user import BaseUserCreate
+
+    loop = asyncio.new_event_loop()
+    client = FakeClient()
+    loop.run_until_complete(create_api_users(client, [
+        (BaseUserCreate(email=f"user{i}@example.com"), False, None)
+        for i in range(LIST_PAGE_SIZE)
+    ]))
+    return lambda: loop.run_until_complete(get_all(client, limit=LIST_PAGE_SIZE))
+
+
+def measure(func, repeat: int, min_time: float) -> dict:
+    """Time a callable and trace its allocations
+    :return: dict of the best time per call and the allocations per call
+    """
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    if elapsed < min_time:
+        number = max(int(number * min_time / max(elapsed, 1e-9)), 1)
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+
+    calls = min(number, 1000)
+    tracemalloc.start()
+    try:
+        func()  # warm caches before tracing
+        tracemalloc.clear_traces()
+        before = tracemalloc.take_snapshot()
+        start_size, _ = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, "reset_peak"):  # python 3.9+
+            tracemalloc.reset_peak()
+        for _ in range(calls):
+            func()
+        end_size, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    allocations = sum(
+        stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0
+    )
+    return {
+        "time_us": round(best * 1e6, 3),
+        "loops": number,
+        "peak_kib": round((peak - start_size) / 1024, 3),
+        "retained_bytes_per_call": round((end_size - start_size) / calls, 1),
+        "retained_blocks_per_call": round(allocations / calls, 2),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Compare results against a baseline
+    :return: list of the names of the benchmarks slower than the baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            result["vs_baseline"] = None
+            continue
+        ratio = result["time_us"] / base["time_us"] if base["time_us"] else 0.0
+        result["vs_baseline"] = round(ratio, 3)
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def load_baseline(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get("results", {})
+
+
+def run(args) -> dict:
+    results = {}
+    pattern = re.compile(args.filter) if args.filter else None
+    for name, setup in benchmarks.items():
+        if pattern is not None and not pattern.search(name):
+            continue
+        results[name] = measure(setup(), args.repeat, args.min_time)
+
+    baseline = load_baseline(args.baseline)
+    regressions = compare(results, baseline, args.tolerance)
+    for name, result in results.items():
+        ratio = result["vs_baseline"]
+        print(
+            f"{name:<45} {result['time_us']:>12.3f}us {result['peak_kib']:>10.3f}KiB peak "
+            f"{result['retained_blocks_per_call']:>8} blocks/call "
+            f"{'' if ratio is None else f'x{ratio:.3f}'}"
+            f"{' REGRESSION' if name in regressions else ''}",
+            file=sys.stderr
+        )
+
+    return {
+        "meta": {
+            "date": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "repeat": args.repeat,
+            "tolerance": args.tolerance,
+        },
+        "results": results,
+        "regressions": regressions,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--filter", help="regex of the benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs, the best is kept")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="minimum duration of a timing run, in seconds")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown against the baseline, as a fraction")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--check", action="store_true", help="exit with 1 on regressions")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    report = run(arguments)
+    if arguments.save_baseline:
+        saved = {**report, "results": {
+            name: {k: v for k, v in result.items() if k != "vs_baseline"}
+            for name, result in report["results"].items()
+        }}
+        saved.pop("regressions")
+        if arguments.filter:
+            # keep the baseline of the benchmarks which were not run
+            saved["results"] = {**load_baseline(arguments.baseline), **saved["results"]}
+        with open(arguments.baseline, "w") as f:
+            f.write(json.dumps(saved, indent=2) + "\n")
+    text = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            f.write(text + "\n")
+    elif not arguments.save_baseline:
+        print(text)
+    if arguments.check and report["regressions"]:
+        sys.exit(1)
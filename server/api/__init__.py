@@ -1,14 +1,18 @@
 from fastapi import APIRouter, Depends
 
+from server.api.endpoints.admin import admin_router
 from server.api.endpoints.user import user_router
 from server.api.endpoints.hello import hello_router
+from server.core.context import ContextRoute
 from server.core.key import validate_request
 
 
-router = APIRouter()
+router = APIRouter(route_class=ContextRoute)
 router.include_router(user_router,
                       prefix="/user")
 router.include_router(hello_router,
                       prefix="/hello",
                       dependencies=[Depends(validate_request)]
                       )
+router.include_router(admin_router,
+                      prefix="/admin")
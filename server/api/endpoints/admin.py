@@ -0,0 +1,78 @@
+"""
+:API admin endpoint:
+Diagnostics of the worker serving the request, for superusers and admins
+"""
+from fastapi import APIRouter, Depends, Path, Query
+from starlette.exceptions import HTTPException
+from starlette.responses import Response
+from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_404_NOT_FOUND
+
+from server.core.context import ContextRoute
+from server.core.health import loop_monitor
+from server.core.key import validate_request
+from server.core.profiler import profiler
+from server.core.watchdog import loop_watchdog
+from server.db.monitoring import command_listener
+from server.models.user import User
+
+admin_router = APIRouter(route_class=ContextRoute)
+
+
+async def require_admin(current_user: User = Depends(validate_request)) -> User:
+    """Allow superusers and admins only
+    """
+    if not (current_user.is_superuser or "admin" in current_user.endpoint_access):
+        raise HTTPException(
+            status_code=HTTP_401_UNAUTHORIZED,
+            detail="Current user does not have sufficient privileges."
+        )
+    return current_user
+
+
+@admin_router.get("/loop")
+async def loop_blocks(current_user: User = Depends(require_admin)):
+    """Event loop lag and the latest blocks reported by the watchdog,
+    most recent first. Blocks are only detected with LOOP_WATCHDOG_ENABLED.
+    """
+    return {
+        "watchdog": loop_watchdog.task is not None,
+        "threshold": loop_watchdog.threshold,
+        "lag": loop_monitor.lag,
+        "max_lag": loop_monitor.max_lag,
+        "blocked": loop_watchdog.blocked,
+        "reports": loop_watchdog.recent(),
+    }
+
+
+@admin_router.get("/profiles")
+async def list_profiles(current_user: User = Depends(require_admin)):
+    """Profiles of the requests sent with the X-Profile header, most recent first
+    """
+    return {"profiles": profiler.recent()}
+
+
+@admin_router.get("/profiles/{profile_id}")
+async def get_profile(
+        profile_id: str = Path(...),
+        current_user: User = Depends(require_admin)
+):
+    """Sampled stacks of a profile in the collapsed format of flame graphs
+    """
+    profile = profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Unknown profile")
+    return Response(profile.collapsed(), media_type="text/plain")
+
+
+@admin_router.get("/mongo")
+async def mongo_commands(
+        current_user: User = Depends(require_admin),
+        limit: int = Query(50, gt=0)
+):
+    """Mongo commands of the worker by query shape, the most time consuming first,
+    with the plan of the slow queries when MONGO_EXPLAIN_ENABLED
+    """
+    return {
+        "slow_threshold": command_listener.slow,
+        "shapes": command_listener.stats(limit),
+    }
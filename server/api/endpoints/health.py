@@ -0,0 +1,28 @@
+"""
+Liveness and readiness probes, without authentication
+"""
+from fastapi import APIRouter, Depends
+from starlette.status import HTTP_200_OK, HTTP_503_SERVICE_UNAVAILABLE
+
+from server.core.context import ContextRoute
+from server.core.health import liveness, readiness
+from server.core.responses import FastJSONResponse
+from server.db.mongodb import AsyncIOMotorClient, get_database
+
+health_router = APIRouter(route_class=ContextRoute)
+
+
+@health_router.get("/live", include_in_schema=False)
+async def live():
+    """The worker is running
+    """
+    return FastJSONResponse(liveness())
+
+
+@health_router.get("/ready", include_in_schema=False)
+async def ready(db: AsyncIOMotorClient = Depends(get_database)):
+    """The worker can serve requests, 503 otherwise
+    """
+    result = await readiness(db)
+    status_code = HTTP_200_OK if result["status"] == "ready" else HTTP_503_SERVICE_UNAVAILABLE
+    return FastJSONResponse(result, status_code=status_code)
@@ -4,7 +4,9 @@ along with Industry, Sector, etc...
 """
 from fastapi import APIRouter
 
-hello_router = APIRouter()
+from server.core.context import ContextRoute
+
+hello_router = APIRouter(route_class=ContextRoute)
 
 
 @hello_router.get("/")
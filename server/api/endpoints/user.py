@@ -2,52 +2,126 @@
 :API users endpoint:
 To register/delete/update/list of all users having api keys
 """
-from typing import Optional
+import asyncio
+import csv
+import io
+from datetime import datetime
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends, Form, Query
-from starlette.responses import JSONResponse
+from fastapi import APIRouter, Body, Depends, Form, Path, Query
+from starlette.responses import StreamingResponse
 from starlette.exceptions import HTTPException
 from starlette.status import (
     HTTP_422_UNPROCESSABLE_ENTITY,
     HTTP_401_UNAUTHORIZED,
-    HTTP_200_OK, HTTP_204_NO_CONTENT
+    HTTP_200_OK
 )
 from pydantic import EmailStr
 from server.db.mongodb import AsyncIOMotorClient, get_database
-from server.db.crud.user import create_api_user, get_all, get_user_by_email
-from server.models.user import BaseUserCreate, User
+from server.db.crud.user import (
+    create_api_user,
+    create_api_users,
+    get_all,
+    get_user_by_email,
+    iter_users
+)
+from server.models.user import BaseUser, BaseUserBulkCreate, BaseUserCreate, User
+from server.core.context import ContextRoute
 from server.core.key import validate_request
+from server.core.responses import FastJSONResponse
+from server.core.settings import USER_LIST_PAGE_SIZE, USER_LIST_MAX_PAGE_SIZE, USER_BULK_MAX_SIZE
 from server.db.crud.helper import (
-    is_email_available,
     verify_email,
     activate_email,
     deactivate_email,
-    reset_api
+    reset_api,
+    bulk_change_status
 )
 from server.core.email.sendgrid import verification_email
 
-user_router = APIRouter()
+user_router = APIRouter(route_class=ContextRoute)
 
 
 @user_router.get("/")
 async def list_users(
         current_user: User = Depends(validate_request),
-        db: AsyncIOMotorClient = Depends(get_database)):
-    """List All users if Superuser or else
-    Show current user information
+        db: AsyncIOMotorClient = Depends(get_database),
+        limit: int = Query(USER_LIST_PAGE_SIZE, ge=1, le=USER_LIST_MAX_PAGE_SIZE),
+        after: str = Query(None),
+        estimate: bool = Query(False)):
+    """List users page by page if Superuser or else
+    Show current user information.
+    Pass the `next_cursor` of a page as `after` to get the next one.
     """
     if current_user.is_superuser or "admin" in current_user.endpoint_access:
-        user_list = await get_all(db)
-        return user_list
+        user_list = await get_all(db, limit=limit, after=after, estimated_count=estimate)
+        # the page is only made of plain values, no need for jsonable_encoder
+        return FastJSONResponse(user_list)
 
     current_user = current_user.dict()
-    rem_info = ['is_superuser', 'is_active', 'endpoint_access', 'disabled']
+    rem_info = [
+        'is_superuser', 'is_active', 'endpoint_access', 'disabled',
+        'rate_limit', 'rate_burst', 'daily_quota'
+    ]
     for k in rem_info:
         del current_user[k]
 
     return current_user
 
 
+async def _export_ndjson(db: AsyncIOMotorClient):
+    async for doc in iter_users(db):
+        yield BaseUser.from_db(doc).json() + "\n"
+
+
+async def _export_csv(db: AsyncIOMotorClient):
+    fields = list(BaseUser.__fields__)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+
+    async for doc in iter_users(db):
+        row = BaseUser.db_dict(doc)
+        row["endpoint_access"] = ",".join(row["endpoint_access"])
+        for field in ("created_at", "updated_at"):
+            if row[field]:
+                row[field] = BaseUser.Config.json_encoders[datetime](row[field])
+        writer.writerow([row[field] for field in fields])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+@user_router.get("/export")
+async def export_users(
+        current_user: User = Depends(validate_request),
+        db: AsyncIOMotorClient = Depends(get_database),
+        export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$")
+):
+    """Export all users as NDJSON or CSV, streamed from the database
+    """
+    if not (current_user.is_superuser or "admin" in current_user.endpoint_access):
+        raise HTTPException(
+            status_code=HTTP_401_UNAUTHORIZED,
+            detail="Current user does not have sufficient privileges."
+        )
+
+    if export_format == "csv":
+        return StreamingResponse(
+            _export_csv(db),
+            media_type="text/csv",
+            headers={"Content-Disposition": "attachment; filename=api_users.csv"}
+        )
+    return StreamingResponse(
+        _export_ndjson(db),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=api_users.ndjson"}
+    )
+
+
 @user_router.post("/new")
 async def create_new_user(
         user_email: EmailStr = Form(...),
@@ -75,10 +149,10 @@ async def create_new_user(
                 )
 
         if user_email:
-            await is_email_available(db, user_email)
+            # the unique email index rejects existing users
             api_key = await create_api_user(db, user, is_superuser, access)
             await verification_email(api_key, user_email)
-            return JSONResponse({user_email: api_key})
+            return FastJSONResponse({user_email: api_key})
         else:
             raise HTTPException(
                 status_code=HTTP_422_UNPROCESSABLE_ENTITY,
@@ -92,6 +166,56 @@ async def create_new_user(
         )
 
 
+@user_router.post("/bulk")
+async def create_new_users(
+        users: List[BaseUserBulkCreate] = Body(...),
+        db: AsyncIOMotorClient = Depends(get_database),
+        current_user: User = Depends(validate_request)
+):
+    """Endpoint to create many New API Users at once
+    """
+    if not (current_user.is_superuser or "admin" in current_user.endpoint_access):
+        # non superuser or non admin
+        raise HTTPException(
+            status_code=HTTP_401_UNAUTHORIZED,
+            detail="Current user does not have sufficient privileges."
+        )
+
+    if any(user.is_superuser for user in users) and not current_user.is_superuser:
+        # Only superusers can create users with superuser
+        raise HTTPException(
+            status_code=HTTP_401_UNAUTHORIZED,
+            detail="Not authorized to create a superuser"
+        )
+
+    if not users or len(users) > USER_BULK_MAX_SIZE:
+        raise HTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Provide between 1 and {USER_BULK_MAX_SIZE} users to create"
+        )
+
+    api_keys = await create_api_users(db, [
+        (BaseUserCreate(email=user.email), user.is_superuser, user.endpoint_access)
+        for user in users
+    ])
+    await asyncio.gather(*(
+        verification_email(api_key, user.email)
+        for user, api_key in zip(users, api_keys) if api_key
+    ))
+
+    results = []
+    for user, api_key in zip(users, api_keys):
+        if api_key:
+            results.append({"email": user.email, "status": "created", "api_key": api_key})
+        else:
+            results.append({
+                "email": user.email,
+                "status": "duplicate",
+                "detail": "User with this email already exists"
+            })
+    return FastJSONResponse({"results": results})
+
+
 @user_router.get("/reset")
 async def reset_api_key(
         email: EmailStr = Query(None),
@@ -221,3 +345,29 @@ async def enable_email(
             status_code=HTTP_401_UNAUTHORIZED,
             detail="Current user does not have sufficient privileges."
         )
+
+
+@user_router.post("/bulk/{action}")
+async def bulk_change_emails(
+        action: str = Path(..., regex="^(disable|enable|verify)$"),
+        emails: List[EmailStr] = Body(...),
+        current_user: User = Depends(validate_request),
+        db: AsyncIOMotorClient = Depends(get_database)
+):
+    """Disable, enable or verify many users at once
+    """
+    if not (current_user.is_superuser or "admin" in current_user.endpoint_access):
+        # non superuser or non admin
+        raise HTTPException(
+            status_code=HTTP_401_UNAUTHORIZED,
+            detail="Current user does not have sufficient privileges."
+        )
+
+    if not emails or len(emails) > USER_BULK_MAX_SIZE:
+        raise HTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Provide between 1 and {USER_BULK_MAX_SIZE} emails"
+        )
+
+    results = await bulk_change_status(db, current_user, emails, action)
+    return FastJSONResponse({"results": results})
@@ -0,0 +1,215 @@
+"""
+Bloom filter of the registered emails, to reject unknown emails without
+a database lookup.
+The filter is built from api_users on startup, emails are added as users
+are created and the users created by the other workers are picked up
+every EMAIL_FILTER_REFRESH_INTERVAL seconds. A user created by another
+worker may thus be unknown to this one until the next refresh. A miss is
+rejected straight away; it only starts an early refresh in the background
+if the last one started more than EMAIL_FILTER_REFRESH_INTERVAL seconds
+ago, e.g. as the periodic ones fail, so a flood of unknown emails never
+costs more than one query of the latest users per interval.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from server.core.cache import SingleFlight
+from server.core.metrics import CallbackGauge
+from server.core.settings import (
+    EMAIL_FILTER_ENABLED,
+    EMAIL_FILTER_CAPACITY,
+    EMAIL_FILTER_FP_RATE,
+    EMAIL_FILTER_REFRESH_INTERVAL
+)
+from server.db.mongodb import AsyncIOMotorClient, db
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """Bloom filter of strings sized for `capacity` items at a false positive rate of `fp_rate`
+    """
+
+    def __init__(self, capacity: int, fp_rate: float):
+        self.capacity = max(capacity, 1)
+        self.fp_rate = fp_rate
+        self.size = max(math.ceil(-self.capacity * math.log(fp_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / self.capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str):
+        added = False
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                added = True
+        if added:
+            self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                return False
+        return True
+
+    def false_positive_rate(self) -> float:
+        """Expected false positive rate at the current number of items
+        """
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class EmailFilter:
+    """Filter of the registered emails. Until it is loaded every email is
+    considered as possibly registered.
+    """
+
+    def __init__(self):
+        self.filter: Optional[BloomFilter] = None
+        self.rejected = 0
+        self.loaded_at: Optional[datetime] = None
+        # monotonic time the last load or refresh started, or an early one was asked for
+        self.synced_at = 0.0
+        self.syncs = SingleFlight()
+        self.task: Optional[asyncio.Task] = None
+        self._building: Optional[list] = None
+
+    def might_exist(self, email: str) -> bool:
+        """Check if an email may be registered, False only if it is not
+        """
+        if self.filter is None or email in self.filter:
+            return True
+        self.rejected += 1
+        if self.task is not None and time.monotonic() - self.synced_at >= EMAIL_FILTER_REFRESH_INTERVAL:
+            self.synced_at = time.monotonic()
+            asyncio.ensure_future(self.sync(db.client))
+        return False
+
+    def add(self, email: str):
+        if self.filter is not None:
+            self.filter.add(email)
+        if self._building is not None:
+            self._building.append(email)
+
+    async def load(self, conn: AsyncIOMotorClient):
+        """Build a new filter of all the registered emails
+        :param conn: AsyncIOMotorClient connection
+        """
+        from server.db.crud.user import iter_emails, total_docs_in_db
+
+        self._building = []
+        try:
+            synced_at = time.monotonic()
+            started = datetime.utcnow()
+            start = time.perf_counter()
+            users = await total_docs_in_db(conn, estimated=True)
+            new_filter = BloomFilter(max(EMAIL_FILTER_CAPACITY, 2 * users), EMAIL_FILTER_FP_RATE)
+            async for email in iter_emails(conn):
+                new_filter.add(email)
+            for email in self._building:
+                new_filter.add(email)
+            self.filter = new_filter
+            self.loaded_at = started
+            self.synced_at = synced_at
+        finally:
+            self._building = None
+
+        stats = self.stats()
+        logger.info(
+            "Email filter loaded with %s emails in %.2fs: %s bytes, expected false positive rate %.5f",
+            stats["count"], time.perf_counter() - start, stats["bytes"], stats["false_positive_rate"]
+        )
+
+    async def refresh(self, conn: AsyncIOMotorClient):
+        """Add the emails created since the last load or refresh, possibly
+        by other workers, rebuilding the filter once it is over capacity
+        :param conn: AsyncIOMotorClient connection
+        """
+        from server.db.crud.user import iter_emails
+
+        if self.filter is None or self.filter.count > self.filter.capacity:
+            await self.load(conn)
+            return
+
+        synced_at = time.monotonic()
+        started = datetime.utcnow()
+        # overlap the previous refresh to allow for clock skew between the workers
+        since = self.loaded_at - timedelta(seconds=EMAIL_FILTER_REFRESH_INTERVAL)
+        async for email in iter_emails(conn, created_since=since):
+            self.filter.add(email)
+        self.loaded_at = started
+        self.synced_at = max(self.synced_at, synced_at)
+
+    def stats(self) -> dict:
+        """Memory use and false positive rate of the filter
+        """
+        if self.filter is None:
+            return {"loaded": False, "rejected": self.rejected}
+        return {
+            "loaded": True,
+            "capacity": self.filter.capacity,
+            "count": self.filter.count,
+            "bytes": len(self.filter.bits),
+            "hashes": self.filter.hashes,
+            "target_false_positive_rate": self.filter.fp_rate,
+            "false_positive_rate": self.filter.false_positive_rate(),
+            "rejected": self.rejected,
+        }
+
+    async def start(self):
+        if not EMAIL_FILTER_ENABLED:
+            return
+        try:
+            await self.load(db.client)
+        except Exception:
+            # the filter is simply not used until a refresh succeeds
+            logger.exception("Loading the email filter failed")
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(EMAIL_FILTER_REFRESH_INTERVAL)
+            await self.sync(db.client)
+
+    async def sync(self, conn: AsyncIOMotorClient):
+        """Refresh the filter, sharing the refresh in progress if any
+        :param conn: AsyncIOMotorClient connection
+        """
+        try:
+            await self.syncs.do("refresh", self.refresh, conn)
+        except Exception:
+            logger.exception("Refreshing the email filter failed")
+
+
+email_filter = EmailFilter()
+
+CallbackGauge("email_filter_bytes", "Memory used by the email filter",
+              lambda: len(email_filter.filter.bits) if email_filter.filter else 0)
+CallbackGauge("email_filter_emails", "Emails in the email filter",
+              lambda: email_filter.filter.count if email_filter.filter else 0)
+CallbackGauge("email_filter_false_positive_rate", "Expected false positive rate of the email filter",
+              lambda: email_filter.filter.false_positive_rate() if email_filter.filter else 0)
+CallbackGauge("email_filter_rejected_total", "Unknown emails rejected by the email filter",
+              lambda: email_filter.rejected, kind="counter")
@@ -0,0 +1,168 @@
+"""
+In-process caches
+"""
+import asyncio
+import hashlib
+import hmac
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+from server.core.metrics import CallbackGauge
+from server.core.settings import AUTH_CACHE_SIZE, AUTH_CACHE_TTL, AUTH_DEGRADED_WINDOW
+
+
+def key_digest(api_key: str) -> str:
+    """Digest of a plain api key, so that plain keys are never kept in memory
+    :param api_key: plain api key as sent by the client
+    :return: hex digest of the api key
+    """
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+class AuthCache:
+    """Bounded LRU cache of successfully verified credentials.
+    One entry is kept per email, holding the digest of the api key that was
+    verified for it and the user that was returned by the auth dependency.
+    """
+
+    def __init__(
+            self,
+            maxsize: int = AUTH_CACHE_SIZE,
+            ttl: float = AUTH_CACHE_TTL,
+            stale_window: float = AUTH_DEGRADED_WINDOW
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_window = stale_window
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._entries = OrderedDict()
+
+    def get(self, email: str, api_key: str):
+        """Get the cached user for a verified email & api key pair
+        :param email: email id of the user
+        :param api_key: plain api key as sent by the client
+        :return: cached user or None
+        """
+        entry = self._entries.get(email)
+        if entry is not None:
+            digest, user, expires_at = entry
+            now = time.monotonic()
+            if expires_at <= now:
+                if expires_at + self.stale_window <= now:
+                    del self._entries[email]
+            elif hmac.compare_digest(digest, key_digest(api_key)):
+                self._entries.move_to_end(email)
+                self.hits += 1
+                return user
+
+        self.misses += 1
+        return None
+
+    def get_stale(self, email: str, api_key: str):
+        """Get the cached user for a verified email & api key pair, even if
+        expired for less than the stale window, for when it cannot be verified again
+        :param email: email id of the user
+        :param api_key: plain api key as sent by the client
+        :return: cached user or None
+        """
+        entry = self._entries.get(email)
+        if entry is not None:
+            digest, user, expires_at = entry
+            if expires_at + self.stale_window > time.monotonic() and \
+                    hmac.compare_digest(digest, key_digest(api_key)):
+                self.stale_hits += 1
+                return user
+        return None
+
+    def put(self, email: str, api_key: str, user):
+        """Cache a user after its email & api key were verified
+        :param email: email id of the user
+        :param api_key: plain api key as sent by the client
+        :param user: user to return on the next hit
+        """
+        if self.maxsize <= 0:
+            return
+
+        self._entries[email] = (key_digest(api_key), user, time.monotonic() + self.ttl)
+        self._entries.move_to_end(email)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, email: Optional[str] = None):
+        """Drop the cached credentials of an email, or of everyone
+        :param email: email id to drop or None to clear the whole cache
+        """
+        if email is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(email, None)
+
+    def stats(self) -> dict:
+        """Hit/miss counters of the cache
+        """
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+        }
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key: while a call is in
+    flight, the calls with its key wait for its result instead of doing
+    the same work again. Results must not be mutated by the callers.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, func, *args):
+        """Call `func(*args)` or wait for the call in flight with the same key
+        :param key: key of the call
+        :param func: coroutine function doing the work
+        :return: result of the call
+        """
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args))
+            self.calls[key] = future
+            future.add_done_callback(lambda done: self._done(key, done))
+        else:
+            self.coalesced += 1
+        # a cancelled caller must not cancel the call of the others
+        return await asyncio.shield(future)
+
+    def _done(self, key: Hashable, future: asyncio.Future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+        if not future.cancelled():
+            # retrieved, even if every caller was cancelled meanwhile
+            future.exception()
+
+    def forget(self, key: Optional[Hashable] = None):
+        """Make the next calls with a key start a new call, e.g. as the data
+        read by the call in flight was changed
+        :param key: key of the call or None for every call
+        """
+        if key is None:
+            self.calls.clear()
+        else:
+            self.calls.pop(key, None)
+
+
+auth_cache = AuthCache()
+
+CallbackGauge("auth_cache_hits_total", "Verified credentials cache hits",
+              lambda: auth_cache.hits, kind="counter")
+CallbackGauge("auth_cache_misses_total", "Verified credentials cache misses",
+              lambda: auth_cache.misses, kind="counter")
+CallbackGauge("auth_cache_stale_hits_total", "Expired credentials accepted while the database is unavailable",
+              lambda: auth_cache.stale_hits, kind="counter")
+CallbackGauge("auth_cache_size", "Verified credentials cached", lambda: len(auth_cache._entries))
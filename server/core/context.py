@@ -0,0 +1,82 @@
+"""
+Request context, for the diagnostics run outside of the request handlers
+"""
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi.routing import APIRoute
+
+
+class Timings:
+    """Phase timings of a request, in seconds. A phase run more than once,
+    e.g. rendering, adds up.
+    """
+    __slots__ = ("start", "phases", "response_ready", "profile_requested", "profile", "admin")
+
+    def __init__(self, profile_requested: bool = False):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.response_ready: Optional[float] = None
+        self.profile_requested = profile_requested
+        self.profile = None
+        # the phases are only returned to admins, they time the authentication
+        self.admin = False
+
+    def add(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+
+# path of the route being served, e.g. "/api/user/"
+current_route: ContextVar[str] = ContextVar("current_route", default="")
+
+# phase timings of the request being served, None outside of the ServerTimingMiddleware
+current_timings: ContextVar[Optional[Timings]] = ContextVar("current_timings", default=None)
+
+# route served by each task, readable from other threads unlike the context variables
+task_routes = {}
+
+
+@contextmanager
+def phase(name: str):
+    """Time a phase of the request being served, if any
+    :param name: name of the phase in the Server-Timing header
+    """
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+class ContextRoute(APIRoute):
+    """Route recording its path in the request context while handling a request,
+    and the time it takes to build the response, validation and dependencies included
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        path = self.path
+
+        async def route_handler(request):
+            token = current_route.set(path)
+            task = asyncio.current_task()
+            task_routes[task] = path
+            try:
+                with phase("route"):
+                    response = await handler(request)
+                timings = current_timings.get()
+                if timings is not None:
+                    timings.response_ready = time.perf_counter()
+                return response
+            finally:
+                task_routes.pop(task, None)
+                current_route.reset(token)
+
+        return route_handler
@@ -0,0 +1,196 @@
+"""
+Email outbox.
+Emails are stored in a collection and delivered by a background worker,
+so that requests never wait for the email provider and a restart does not
+lose mail. The outbox stores the template of an email and its secret, an
+api key, encrypted with SECRET_KEY: the email is only rendered in memory
+by the worker delivering it. Delivered emails are deleted from the outbox,
+and the secret of the emails given up on is removed.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+
+from server.core.email.templates import templates
+from server.core.email.transport import EmailTransport, get_transport
+from server.core.metrics import EMAIL_SEND_SECONDS
+from server.core.security import decrypt_secret, encrypt_secret
+from server.core.settings import (
+    mongo_db,
+    FROM_EMAIL,
+    EMAIL_TRANSPORT,
+    EMAIL_OUTBOX_BATCH_SIZE,
+    EMAIL_OUTBOX_POLL_INTERVAL,
+    EMAIL_OUTBOX_MAX_ATTEMPTS,
+    EMAIL_OUTBOX_BACKOFF,
+    EMAIL_OUTBOX_LEASE
+)
+from server.db.mongodb import AsyncIOMotorClient, db, register_indexes
+
+logger = logging.getLogger(__name__)
+
+outbox_collection = "email_outbox"
+
+register_indexes(
+    outbox_collection,
+    IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt"),
+)
+
+
+async def enqueue_email(to_email: str, template: str, secret: str):
+    """Add an email to the outbox, it is delivered in the background
+    :param to_email: To email address
+    :param template: name of the template of the email in `templates`
+    :param secret: secret rendered in the email, stored encrypted
+    """
+    now = datetime.utcnow()
+    await db.client[mongo_db][outbox_collection].insert_one({
+        "from_email": FROM_EMAIL,
+        "to_email": to_email,
+        "subject": templates[template][0],
+        "template": template,
+        "secret": encrypt_secret(secret),
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now,
+    })
+    if outbox_worker.wakeup is not None:
+        outbox_worker.wakeup.set()
+
+
+def render_email(message: dict) -> dict:
+    """The email of an outbox message, with its html content rendered
+    :param message: document of the outbox
+    :return: message to deliver with a transport
+    """
+    render = templates[message["template"]][1]
+    return {
+        **message,
+        "html_content": render(decrypt_secret(message["secret"]), message["to_email"])
+    }
+
+
+async def outbox_backlog(conn: AsyncIOMotorClient, limit: int = 0) -> int:
+    """Count the emails waiting for delivery
+    :param conn: AsyncIOMotorClient connection
+    :param limit: stop counting at this number, 0 for no limit
+    :return: number of pending or leased emails
+    """
+    options = {"limit": limit} if limit > 0 else {}
+    return await conn[mongo_db][outbox_collection].count_documents(
+        {"status": {"$in": ["pending", "sending"]}}, **options
+    )
+
+
+class OutboxWorker:
+    """Background task delivering the emails of the outbox in batches
+    """
+
+    def __init__(self, transport: Optional[EmailTransport] = None):
+        self.transport = transport
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.transport is None:
+            self.transport = get_transport(EMAIL_TRANSPORT)
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                delivered = await self.deliver_batch(db.client)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Email outbox delivery failed")
+                delivered = 0
+
+            if delivered < EMAIL_OUTBOX_BATCH_SIZE:
+                # outbox drained, wait for new emails or retries
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), EMAIL_OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _claim(self, conn: AsyncIOMotorClient) -> Optional[dict]:
+        """Lease the next email due for delivery. While leased, next_attempt_at
+        is the end of the lease, so that emails leased by a worker that went
+        away are claimed again once their lease expired
+        """
+        now = datetime.utcnow()
+        return await conn[mongo_db][outbox_collection].find_one_and_update(
+            {"status": {"$in": ["pending", "sending"]}, "next_attempt_at": {"$lte": now}},
+            {"$set": {
+                "status": "sending",
+                "next_attempt_at": now + timedelta(seconds=EMAIL_OUTBOX_LEASE)
+            }},
+            sort=[("next_attempt_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def deliver_batch(self, conn: AsyncIOMotorClient) -> int:
+        """Deliver up to EMAIL_OUTBOX_BATCH_SIZE due emails
+        :param conn: AsyncIOMotorClient connection
+        :return: number of emails claimed
+        """
+        messages = []
+        while len(messages) < EMAIL_OUTBOX_BATCH_SIZE:
+            message = await self._claim(conn)
+            if message is None:
+                break
+            messages.append(message)
+
+        await asyncio.gather(*(self._deliver(conn, message) for message in messages))
+        return len(messages)
+
+    async def _deliver(self, conn: AsyncIOMotorClient, message: dict):
+        outbox = conn[mongo_db][outbox_collection]
+        transport = type(self.transport).__name__
+        start = time.perf_counter()
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                None, self.transport.send, render_email(message)
+            )
+        except Exception as e:
+            EMAIL_SEND_SECONDS.labels(transport, "failure").observe(time.perf_counter() - start)
+            attempts = message["attempts"] + 1
+            if attempts >= EMAIL_OUTBOX_MAX_ATTEMPTS:
+                logger.error("Giving up on email to %s after %d attempts: %s",
+                             message["to_email"], attempts, e)
+                await outbox.update_one({"_id": message["_id"]}, {
+                    "$set": {"status": "failed", "attempts": attempts, "error": str(e)},
+                    "$unset": {"secret": ""}
+                })
+            else:
+                backoff = EMAIL_OUTBOX_BACKOFF * 2 ** (attempts - 1)
+                logger.warning("Email to %s failed, retrying in %ss: %s",
+                               message["to_email"], backoff, e)
+                await outbox.update_one({"_id": message["_id"]}, {"$set": {
+                    "status": "pending",
+                    "attempts": attempts,
+                    "error": str(e),
+                    "next_attempt_at": datetime.utcnow() + timedelta(seconds=backoff)
+                }})
+        else:
+            EMAIL_SEND_SECONDS.labels(transport, "success").observe(time.perf_counter() - start)
+            await outbox.delete_one({"_id": message["_id"]})
+
+
+outbox_worker = OutboxWorker()
@@ -0,0 +1,35 @@
+"""
+Email templates.
+The outbox stores the name of a template and its secret encrypted, the
+email is only rendered by the worker delivering it.
+"""
+
+
+def verification(api_key, email_address):
+    """Email sent when an account gets created
+    :param api_key: an api key that needs to be sent
+    :param email_address: To email address
+    """
+    return f'<strong>CDE API Key</strong><p>Your CDE API Key is: \
+    <b>{api_key}</b><br/>Verify your email address to start using your API key:&nbsp;\
+    https://cde.to/api/user/verify?email={email_address}</p><p>Please do not loose your \
+    api key, as the key is not stored in our system.</p><p>If you loose your api key, \
+    you would need to reset your API key by following the link below:<br>\
+    https://cde.to/api/user/reset?email={email_address}</p>'
+
+
+def reset(api_key, email_address):
+    """Email sent when a API reset is required
+    :param api_key: an api key that needs to be sent
+    :param email_address: To email address
+    """
+    return f'<strong>CDE API Key Reset</strong><p> You are someone has requested an reset of \
+    your API Key for your email address<br/>Your new API Key is: <b>{api_key}</b></p><p>Please update \
+    any or all of your scripts with your new API Key.'
+
+
+# template name: (subject, function(secret, email address) rendering the html content)
+templates = {
+    "verification": ("[CDE] Verification Email", verification),
+    "reset": ("[CDE] API Reset Email", reset),
+}
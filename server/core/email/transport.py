@@ -0,0 +1,64 @@
+"""
+Email transports used by the outbox worker to deliver emails
+"""
+import logging
+
+from sendgrid import SendGridAPIClient
+from sendgrid.helpers.mail import Mail
+from server.core.settings import SG_API
+
+logger = logging.getLogger(__name__)
+
+
+class EmailTransport:
+    """Delivers one email. `send` is blocking and is run off the event loop,
+    it raises on failure so that the email is retried.
+    """
+
+    def send(self, message: dict):
+        raise NotImplementedError
+
+
+class SendGridTransport(EmailTransport):
+    """Delivers emails through Sendgrid, reusing a single client
+    """
+
+    def __init__(self, api_key: str = SG_API):
+        self.client = SendGridAPIClient(api_key)
+
+    def send(self, message: dict):
+        response = self.client.send(Mail(
+            from_email=message["from_email"],
+            to_emails=message["to_email"],
+            subject=message["subject"],
+            html_content=message["html_content"]
+        ))
+        if response.status_code >= 300:
+            raise RuntimeError(f"Sendgrid responded with {response.status_code}")
+        return response
+
+
+class LocalTransport(EmailTransport):
+    """Keeps emails in memory instead of sending them, for development and tests
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message: dict):
+        logger.info("Email to %s: %s", message["to_email"], message["subject"])
+        self.sent.append(message)
+
+
+transports = {
+    "sendgrid": SendGridTransport,
+    "local": LocalTransport,
+}
+
+
+def get_transport(name: str) -> EmailTransport:
+    """Get a transport by name
+    :param name: one of the names registered in `transports`
+    :return: EmailTransport instance
+    """
+    return transports[name]()
@@ -0,0 +1,127 @@
+"""
+Liveness and readiness of the worker.
+Readiness results are cached for HEALTH_CACHE_TTL seconds and concurrent
+probes share one check, so that probes never add load to the database.
+"""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from pymongo.errors import PyMongoError
+
+from server.core.cache import SingleFlight
+from server.core.email.outbox import outbox_backlog
+from server.core.metrics import CallbackGauge
+from server.core.settings import (
+    HEALTH_CACHE_TTL,
+    HEALTH_PING_TIMEOUT,
+    HEALTH_MAX_LOOP_LAG,
+    HEALTH_LOOP_LAG_INTERVAL,
+    HEALTH_OUTBOX_COUNT_LIMIT
+)
+from server.db.breaker import db_breaker
+from server.db.mongodb import AsyncIOMotorClient
+from server.db.monitoring import pool_listener
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop runs a callback scheduled every
+    HEALTH_LOOP_LAG_INTERVAL seconds, i.e. for how long it was blocked
+    """
+
+    def __init__(self, interval: float = HEALTH_LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    async def run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag = max(time.monotonic() - expected, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+loop_monitor = LoopLagMonitor()
+
+CallbackGauge("event_loop_lag_seconds", "Latest delay of the event loop", lambda: loop_monitor.lag)
+
+
+class Health:
+    started_at: float = time.monotonic()
+    ready: Optional[dict] = None
+    checked_at: float = 0.0
+    checks: SingleFlight = SingleFlight()
+
+
+health = Health()
+
+
+def liveness() -> dict:
+    """Liveness of the worker, answering means the event loop runs
+    """
+    return {
+        "status": "alive",
+        "uptime": round(time.monotonic() - health.started_at, 3),
+        "loop_lag": round(loop_monitor.lag, 6),
+    }
+
+
+async def _ping(conn: AsyncIOMotorClient) -> dict:
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(conn.admin.command("ping"), HEALTH_PING_TIMEOUT)
+    except (PyMongoError, asyncio.TimeoutError) as e:
+        return {"ok": False, "error": repr(e)}
+    return {"ok": True, "latency": round(time.perf_counter() - start, 6)}
+
+
+async def _outbox(conn: AsyncIOMotorClient) -> Optional[int]:
+    try:
+        return await asyncio.wait_for(
+            outbox_backlog(conn, limit=HEALTH_OUTBOX_COUNT_LIMIT), HEALTH_PING_TIMEOUT
+        )
+    except (PyMongoError, asyncio.TimeoutError):
+        return None
+
+
+async def _check(conn: AsyncIOMotorClient) -> dict:
+    mongo, backlog = await asyncio.gather(_ping(conn), _outbox(conn))
+    ready = mongo["ok"] and loop_monitor.lag < HEALTH_MAX_LOOP_LAG
+    return {
+        "status": "ready" if ready else "unavailable",
+        "mongo": {**mongo, "breaker": db_breaker.state, "pool": pool_listener.stats()},
+        "email_outbox_backlog": backlog,
+        "loop_lag": round(loop_monitor.lag, 6),
+        "loop_lag_max": round(loop_monitor.max_lag, 6),
+    }
+
+
+async def readiness(conn: AsyncIOMotorClient) -> dict:
+    """Readiness of the worker to serve requests: mongo answers a ping and
+    the event loop is not blocked. Cached for HEALTH_CACHE_TTL seconds.
+    :param conn: AsyncIOMotorClient connection
+    :return: dict of the status and of the details of each check
+    """
+    if health.ready is None or time.monotonic() - health.checked_at >= HEALTH_CACHE_TTL:
+        health.ready = await health.checks.do("ready", _check, conn)
+        health.checked_at = time.monotonic()
+        if health.ready["status"] != "ready":
+            logger.warning("Not ready: %s", health.ready)
+    return health.ready
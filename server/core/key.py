@@ -1,22 +1,44 @@
 """
 Api Key validation
 """
+import logging
 from typing import Optional
 
 from fastapi.security.api_key import APIKeyHeader
 from fastapi import HTTPException, Security, Depends
 from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_400_BAD_REQUEST, HTTP_403_FORBIDDEN
 
-from server.core.security import verify_key
+from server.core.bloom import email_filter
+from server.core.cache import SingleFlight, auth_cache, key_digest
+from server.core.context import phase
+from server.core.metrics import AUTH_DB_SECONDS, AUTH_VERIFY_SECONDS, CallbackGauge
+from server.core.ratelimit import rate_limiter
+from server.core.security import (
+    verify_key,
+    verify_key_async,
+    get_key_hash_async,
+    is_hmac_hash,
+    needs_rehash
+)
+from server.core.timing import trace_request
+from server.db.breaker import DatabaseUnavailable
 from server.db.mongodb import AsyncIOMotorClient, get_database
 from server.models.user import User
-from server.db.crud.user import get_user_by_email
+from server.db.crud.user import get_user_by_email, update_user_fields
 from pydantic import EmailStr
 
 
+logger = logging.getLogger(__name__)
+
 api_key_scheme = APIKeyHeader(name="X-API-KEY", auto_error=False)
 email_scheme = APIKeyHeader(name="X-EMAIL-ID", auto_error=False)
 
+# concurrent verifications of the same key against the same hash share one verification
+key_verifications = SingleFlight()
+
+CallbackGauge("auth_verify_coalesced_total", "API key verifications served by one in flight",
+              lambda: key_verifications.coalesced, kind="counter")
+
 
 async def validate_request(
         api_key: Optional[str] = Security(api_key_scheme),
@@ -35,17 +57,58 @@ async def validate_request(
             status_code=HTTP_400_BAD_REQUEST, detail="X-EMAIL-ID is missing", headers={}
         )
 
-    user = await get_user_by_email(db, email_id)
+    cached_user = auth_cache.get(email_id, api_key)
+    if cached_user is not None:
+        rate_limiter.check(cached_user)
+        trace_request(cached_user)
+        return cached_user
+
+    if not email_filter.might_exist(email_id):
+        raise HTTPException(
+            status_code=HTTP_400_BAD_REQUEST, detail="Unknown Email", headers={}
+        )
+
+    try:
+        with AUTH_DB_SECONDS.time(), phase("auth_db"):
+            user = await get_user_by_email(db, email_id)
+    except DatabaseUnavailable:
+        # degraded mode: accept the credentials verified recently
+        stale_user = auth_cache.get_stale(email_id, api_key)
+        if stale_user is None:
+            raise
+        logger.warning("Database unavailable, accepting the cached credentials of %s", email_id)
+        rate_limiter.check(stale_user)
+        trace_request(stale_user)
+        return stale_user
 
     # verify email & API key
     if user:
-        api_key = str(user.salt) + str(api_key)
-
-        if not verify_key(api_key, user.hashed_api_key):
+        with AUTH_VERIFY_SECONDS.time(), phase("auth_verify"):
+            if is_hmac_hash(user.hashed_api_key):
+                # verified inline in microseconds, nothing worth sharing
+                verified = verify_key(str(user.salt) + str(api_key), user.hashed_api_key)
+            else:
+                verified = await key_verifications.do(
+                    (user.hashed_api_key, key_digest(str(api_key))),
+                    verify_key_async, str(user.salt) + str(api_key), user.hashed_api_key
+                )
+        if not verified:
             # api key mismatch
             raise HTTPException(
                 status_code=HTTP_401_UNAUTHORIZED, detail="Access not allowed", headers={}
             )
+        if needs_rehash(user.hashed_api_key):
+            # upgrade the stored hash to the current scheme now that the key is known
+            # unless another request changed it meanwhile
+            new_hash = await get_key_hash_async(str(user.salt) + str(api_key))
+            try:
+                await update_user_fields(
+                    db, email_id, {"hashed_api_key": new_hash},
+                    expected={"hashed_api_key": user.hashed_api_key}
+                )
+            except DatabaseUnavailable:
+                # upgraded on a later request
+                pass
         if user.disabled:
             # disabled user
             raise HTTPException(
@@ -58,7 +121,11 @@ async def validate_request(
             )
 
         # All verified
-        return User(**user.dict())
+        current_user = User.from_db(user.__dict__)
+        auth_cache.put(email_id, api_key, current_user)
+        rate_limiter.check(current_user)
+        trace_request(current_user)
+        return current_user
     else:
         # not a valid email provided
         raise HTTPException(
@@ -0,0 +1,243 @@
+"""
+In process metrics, exposed in the Prometheus text format
+"""
+import threading
+import time
+from bisect import bisect_left
+
+# default histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+class Registry:
+    metrics: list = []
+
+
+registry = Registry()
+
+
+def _labels_str(labelnames, values, extra=""):
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(labelnames, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Timer:
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, description: str, labelnames: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._children = {}
+        self._lock = threading.Lock()
+        registry.metrics.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class _Value:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_labels_str(self.labelnames, values)} {child.value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class CallbackGauge(Metric):
+    """Gauge (or counter) whose value is read from a callback when rendered
+    """
+
+    def __init__(self, name: str, description: str, callback, kind: str = "gauge"):
+        super().__init__(name, description)
+        self.callback = callback
+        self.kind = kind
+
+    def samples(self):
+        yield f"{self.name} {self.callback()}"
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: tuple = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.bounds = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.bounds)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        return self.labels().time()
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), child.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _labels_str(self.labelnames, values, f'le="{le}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _labels_str(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {child.sum}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+def render_metrics() -> str:
+    """All the metrics in the Prometheus text format
+    """
+    return "\n".join(metric.render() for metric in registry.metrics) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording the latency, status and in flight count of the requests
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.routes = None
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "<unmatched>"
+        if self.routes is None or endpoint not in self.routes:
+            self.routes = {
+                getattr(route, "endpoint", None): route.path for route in scope["app"].routes
+            }
+        return self.routes.get(endpoint, "<unmatched>")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            HTTP_REQUEST_SECONDS.labels(scope["method"], self._route(scope), status).observe(
+                time.perf_counter() - start
+            )
+
+
+HTTP_REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being served")
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Request latency by route and status",
+    ("method", "route", "status")
+)
+AUTH_DB_SECONDS = Histogram("auth_db_lookup_seconds", "User lookup time of the auth dependency")
+AUTH_VERIFY_SECONDS = Histogram(
+    "auth_key_verify_seconds", "API key verification time of the auth dependency"
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    "mongo_command_duration_seconds", "Mongo command latency by collection and command",
+    ("collection", "command", "outcome")
+)
+EMAIL_SEND_SECONDS = Histogram(
+    "email_send_duration_seconds", "Email delivery latency by transport",
+    ("transport", "outcome"), buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
@@ -0,0 +1,129 @@
+"""
+Sampling profiler of single requests.
+A thread samples the stack of the event loop thread every PROFILER_INTERVAL
+seconds while the task of the request runs on the loop, leaving out the
+other requests served meanwhile and the time spent awaiting. Stacks are
+aggregated in the collapsed format of flame graphs (flamegraph.pl,
+speedscope) and the latest PROFILER_STORED profiles of the worker are kept
+for the admin endpoints.
+"""
+import asyncio
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime
+from typing import Optional
+
+from server.core.settings import (
+    PROFILER_INTERVAL,
+    PROFILER_MAX_SECONDS,
+    PROFILER_MAX_ACTIVE,
+    PROFILER_STORED
+)
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class RequestProfile:
+
+    def __init__(self, profile_id: str, route: str, interval: float = PROFILER_INTERVAL):
+        self.id = profile_id
+        self.route = route
+        self.interval = interval
+        self.task = asyncio.current_task()
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread = threading.get_ident()
+        self.at = datetime.utcnow().isoformat() + "Z"
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.samples = 0
+        self.stacks = Counter()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._sample, name=f"profiler-{profile_id}", daemon=True)
+
+    def _sample(self):
+        deadline = time.monotonic() + PROFILER_MAX_SECONDS
+        while not self.stopping.wait(self.interval) and time.monotonic() < deadline:
+            if asyncio.current_task(self.loop) is not self.task:
+                # awaiting, or the loop serves another request
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None or asyncio.current_task(self.loop) is not self.task:
+                continue
+            self.stacks[_collapse(frame)] += 1
+            self.samples += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.duration = time.perf_counter() - self.started
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "at": self.at,
+            "route": self.route,
+            "duration": round(self.duration, 6),
+            "interval": self.interval,
+            "samples": self.samples,
+        }
+
+    def collapsed(self) -> str:
+        """Sampled stacks in the collapsed format, one `frame;frame;... count` per line
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class Profiler:
+
+    def __init__(self, stored: int = PROFILER_STORED, max_active: int = PROFILER_MAX_ACTIVE):
+        self.stored = stored
+        self.max_active = max_active
+        self.active = 0
+        self.profiles = OrderedDict()
+        self.ids = itertools.count(1)
+
+    def start(self, route: str) -> Optional[RequestProfile]:
+        """Profile the task being run until stop
+        :param route: route being served
+        :return: the profile, None when too many requests are being profiled
+        """
+        if self.active >= self.max_active:
+            return None
+        self.active += 1
+        # ids tell the worker holding the profile apart
+        profile = RequestProfile(f"{os.getpid()}-{next(self.ids)}", route)
+        profile.start()
+        return profile
+
+    async def stop(self, profile: RequestProfile):
+        # joining the sampling thread waits for its current sample, off the loop
+        await asyncio.get_event_loop().run_in_executor(None, profile.stop)
+        self.active -= 1
+        self.profiles[profile.id] = profile
+        while len(self.profiles) > self.stored:
+            self.profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> Optional[RequestProfile]:
+        return self.profiles.get(profile_id)
+
+    def recent(self) -> list:
+        """Summaries of the stored profiles, most recent first
+        """
+        return [profile.summary() for profile in reversed(self.profiles.values())]
+
+
+profiler = Profiler()
@@ -0,0 +1,153 @@
+"""
+Per API key rate limits and daily quotas.
+Requests are counted in memory; daily usage is periodically added up in
+the api_usage collection, which also gives back the usage of the other
+workers. Quotas are thus enforced across workers within one flush interval.
+"""
+import asyncio
+import logging
+import math
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import HTTPException
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS
+
+from server.core.settings import (
+    mongo_db,
+    RATE_LIMIT_DEFAULT,
+    RATE_BURST_DEFAULT,
+    DAILY_QUOTA_DEFAULT,
+    USAGE_FLUSH_INTERVAL
+)
+from server.db.mongodb import AsyncIOMotorClient, db, register_indexes
+from server.models.user import BaseUser
+
+logger = logging.getLogger(__name__)
+
+usage_collection = "api_usage"
+
+register_indexes(
+    usage_collection,
+    IndexModel([("email", ASCENDING), ("day", ASCENDING)], name="email_day_unique", unique=True),
+)
+
+
+def _today() -> str:
+    return datetime.utcnow().strftime("%Y-%m-%d")
+
+
+def _seconds_to_midnight() -> int:
+    now = datetime.utcnow()
+    midnight = datetime(now.year, now.month, now.day) + timedelta(days=1)
+    return math.ceil((midnight - now).total_seconds())
+
+
+class RateLimiter:
+    """Token bucket rate limit and daily quota per user.
+    A limit of 0 means unlimited; limits of a user default to the settings.
+    """
+
+    def __init__(self):
+        self.buckets = {}   # email: [tokens, last refill, time when full again]
+        self.pending = {}   # (email, day): requests not flushed yet
+        self.usage = {}     # (email, day): requests of all workers, as of the last flush
+        self.task: Optional[asyncio.Task] = None
+
+    def check(self, user: BaseUser):
+        """Count a request of a user, raise a 429 if the user is over a limit
+        :param user: user doing the request
+        """
+        rate = user.rate_limit if user.rate_limit is not None else RATE_LIMIT_DEFAULT
+        if rate > 0:
+            burst = user.rate_burst if user.rate_burst is not None else RATE_BURST_DEFAULT
+            burst = max(burst, 1)
+            now = time.monotonic()
+            bucket = self.buckets.get(user.email)
+            if bucket is None:
+                bucket = self.buckets[user.email] = [burst, now, now]
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                raise HTTPException(
+                    status_code=HTTP_429_TOO_MANY_REQUESTS,
+                    detail="Rate limit exceeded",
+                    headers={"Retry-After": str(math.ceil((1 - bucket[0]) / rate))}
+                )
+
+        quota = user.daily_quota if user.daily_quota is not None else DAILY_QUOTA_DEFAULT
+        key = (user.email, _today())
+        if quota > 0 and self.usage.get(key, 0) + self.pending.get(key, 0) >= quota:
+            raise HTTPException(
+                status_code=HTTP_429_TOO_MANY_REQUESTS,
+                detail="Daily quota exceeded",
+                headers={"Retry-After": str(_seconds_to_midnight())}
+            )
+
+        if rate > 0:
+            bucket[0] -= 1
+            bucket[2] = bucket[1] + (burst - bucket[0]) / rate
+        self.pending[key] = self.pending.get(key, 0) + 1
+
+    async def flush(self, conn: AsyncIOMotorClient):
+        """Add the pending requests to the daily usage in the database
+        and get back the usage of all workers
+        :param conn: AsyncIOMotorClient connection
+        """
+        pending = list(self.pending.items())
+        self.pending = {}
+        today = _today()
+        usage = {}
+        for i, ((email, day), count) in enumerate(pending):
+            try:
+                row = await conn[mongo_db][usage_collection].find_one_and_update(
+                    {"email": email, "day": day},
+                    {"$inc": {"count": count}, "$set": {"updated_at": datetime.utcnow()}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+            except Exception:
+                # keep the requests not flushed for the next flush
+                for key, not_flushed in pending[i:]:
+                    self.pending[key] = self.pending.get(key, 0) + not_flushed
+                raise
+            if day == today:
+                usage[(email, day)] = row["count"]
+
+        # usage of previous days is not needed anymore
+        self.usage = {
+            key: count for key, count in self.usage.items() if key[1] == today and key not in usage
+        }
+        self.usage.update(usage)
+
+        # buckets full again are the same as new ones, no need to keep them
+        now = time.monotonic()
+        self.buckets = {
+            email: bucket for email, bucket in self.buckets.items() if bucket[2] > now
+        }
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            await self.flush(db.client)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+            try:
+                await self.flush(db.client)
+            except Exception:
+                logger.exception("Flushing api usage failed")
+
+
+rate_limiter = RateLimiter()
@@ -1,23 +1,152 @@
 """
 Security
 """
+import asyncio
+import base64
+import hashlib
+import hmac
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from cryptography.fernet import Fernet
 from passlib.context import CryptContext
+from starlette.exceptions import HTTPException
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
 
 import bcrypt
 
+from server.core.metrics import CallbackGauge
+from server.core.settings import (
+    SECRET_KEY,
+    API_KEY_HASH_SCHEME,
+    HASH_POOL_KIND,
+    HASH_POOL_SIZE,
+    HASH_POOL_QUEUE_DEPTH
+)
+
 
 apikey_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# keyed digest scheme: $hmac-sha256$<hex digest>
+# api keys are random 256 bit tokens, so a keyed digest is enough and
+# verifies in microseconds, unlike bcrypt.
+HMAC_SCHEME = "$hmac-sha256$"
+
+
+class HashPool:
+    """Pool running the CPU bound key hashing off the event loop.
+    At most `size + queue_depth` jobs are accepted at once, any more
+    are rejected instead of piling up behind a slow pool.
+    """
+    executor: Executor = None
+    pending: int = 0
+
+
+hash_pool = HashPool()
+
+CallbackGauge("hash_pool_pending", "Key hashing jobs running or queued", lambda: hash_pool.pending)
+
 
 def generate_salt():
     return bcrypt.gensalt().decode()
 
 
+def _hmac_digest(apikey):
+    return hmac.new(str(SECRET_KEY).encode(), apikey.encode(), hashlib.sha256).hexdigest()
+
+
+def is_hmac_hash(hashed_apikey):
+    return hashed_apikey.startswith(HMAC_SCHEME)
+
+
+def needs_rehash(hashed_apikey):
+    """Check if a hash is not of the configured scheme and should be upgraded
+    """
+    return API_KEY_HASH_SCHEME == "hmac" and not is_hmac_hash(hashed_apikey)
+
+
 def verify_key(plain_apikey, hashed_apikey):
+    if is_hmac_hash(hashed_apikey):
+        return hmac.compare_digest(_hmac_digest(plain_apikey), hashed_apikey[len(HMAC_SCHEME):])
     return apikey_context.verify(plain_apikey, hashed_apikey)
 
 
 def get_key_hash(apikey):
+    """Hash a (salted) api key with the configured scheme
+    :param apikey: salted api key to hash
+    :return: hash of the api key
+    """
+    if API_KEY_HASH_SCHEME == "hmac":
+        return HMAC_SCHEME + _hmac_digest(apikey)
     return apikey_context.hash(apikey)
 
 
+def _secret_cipher() -> Fernet:
+    # a key of its own derived from SECRET_KEY, which also keys the api key digests
+    key = hmac.new(str(SECRET_KEY).encode(), b"secrets", hashlib.sha256).digest()
+    return Fernet(base64.urlsafe_b64encode(key))
+
+
+def encrypt_secret(secret: str) -> str:
+    """Encrypt a secret to store, e.g. an api key waiting to be emailed
+    :param secret: secret in plain text
+    :return: authenticated token of the encrypted secret
+    """
+    return _secret_cipher().encrypt(secret.encode()).decode()
+
+
+def decrypt_secret(token: str) -> str:
+    """Decrypt a secret encrypted with encrypt_secret, raises InvalidToken
+    if it was not encrypted with the current SECRET_KEY
+    :param token: token of the encrypted secret
+    :return: secret in plain text
+    """
+    return _secret_cipher().decrypt(token.encode()).decode()
+
+
+def _get_executor() -> Executor:
+    if hash_pool.executor is None:
+        if HASH_POOL_KIND == "process":
+            hash_pool.executor = ProcessPoolExecutor(max_workers=HASH_POOL_SIZE)
+        else:
+            hash_pool.executor = ThreadPoolExecutor(
+                max_workers=HASH_POOL_SIZE, thread_name_prefix="hash-pool"
+            )
+    return hash_pool.executor
+
+
+async def _run_in_pool(func, *args):
+    if hash_pool.pending >= HASH_POOL_SIZE + HASH_POOL_QUEUE_DEPTH:
+        raise HTTPException(
+            status_code=HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, try again later"
+        )
+
+    hash_pool.pending += 1
+    try:
+        return await asyncio.get_event_loop().run_in_executor(_get_executor(), func, *args)
+    finally:
+        hash_pool.pending -= 1
+
+
+async def verify_key_async(plain_apikey, hashed_apikey):
+    """verify_key run in the hash pool, hmac digests are verified inline
+    """
+    if is_hmac_hash(hashed_apikey):
+        return verify_key(plain_apikey, hashed_apikey)
+    return await _run_in_pool(verify_key, plain_apikey, hashed_apikey)
+
+
+async def get_key_hash_async(apikey):
+    """get_key_hash run in the hash pool, hmac digests are computed inline
+    """
+    if API_KEY_HASH_SCHEME == "hmac":
+        return get_key_hash(apikey)
+    return await _run_in_pool(get_key_hash, apikey)
+
+
+def close_hash_pool():
+    """Shutdown the hash pool
+    """
+    if hash_pool.executor is not None:
+        hash_pool.executor.shutdown(wait=True)
+        hash_pool.executor = None
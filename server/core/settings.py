@@ -2,6 +2,7 @@
 Project Settings file
 """
 import os
+import socket
 from starlette.datastructures import CommaSeparatedStrings, Secret
 
 default_route_str = "/api"
@@ -13,11 +14,117 @@ SECRET_KEY = Secret(os.getenv(
     "4bf4f696a653b292bc674daacd25195b93fce08a8dac7373b36c38f63cd442938b12ef911bd5d7d0")
 )
 
+# Production server, run with `python -m server.launcher`.
+# Each worker is a process with its own Mongo pool of MAX_CONNECTIONS_COUNT connections.
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", 8000))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", os.cpu_count() or 1))
+SERVER_LOOP = os.getenv("SERVER_LOOP", "uvloop")
+SERVER_HTTP = os.getenv("SERVER_HTTP", "httptools")
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", 2048))
+# keep-alive timeout, longer than the idle timeout of the load balancer in front
+SERVER_KEEPALIVE = int(os.getenv("SERVER_KEEPALIVE", 75))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", 30))
+SERVER_LIMIT_CONCURRENCY = int(os.getenv("SERVER_LIMIT_CONCURRENCY", 0)) or None
+SERVER_LOG_LEVEL = os.getenv("SERVER_LOG_LEVEL", "info")
+SERVER_ACCESS_LOG = os.getenv("SERVER_ACCESS_LOG", "false").lower() == "true"
+SERVER_FORWARDED_ALLOW_IPS = os.getenv("SERVER_FORWARDED_ALLOW_IPS", "127.0.0.1")
+
 # Mongo configuration
 mongo_max_connections = int(os.getenv("MAX_CONNECTIONS_COUNT", 10))
 mongo_min_connections = int(os.getenv("MIN_CONNECTIONS_COUNT", 10))
 mongo_db = "fastapi"
 mongo_url = f"mongodb://localhost:27017/{mongo_db}"
+# driver timeouts in seconds, instead of waiting ~30s for a server during a failover
+MONGO_SERVER_SELECTION_TIMEOUT = float(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT", 3))
+MONGO_CONNECT_TIMEOUT = float(os.getenv("MONGO_CONNECT_TIMEOUT", 3))
+MONGO_SOCKET_TIMEOUT = float(os.getenv("MONGO_SOCKET_TIMEOUT", 10))
+# deadline of the user operations, and the circuit breaker opening after
+# MONGO_BREAKER_FAILURES consecutive failures for MONGO_BREAKER_RESET_TIMEOUT seconds
+MONGO_OPERATION_TIMEOUT = float(os.getenv("MONGO_OPERATION_TIMEOUT", 5))
+MONGO_BREAKER_FAILURES = int(os.getenv("MONGO_BREAKER_FAILURES", 5))
+MONGO_BREAKER_RESET_TIMEOUT = float(os.getenv("MONGO_BREAKER_RESET_TIMEOUT", 10))
+# commands slower than MONGO_SLOW_COMMAND seconds are logged with the route running
+# them, and with MONGO_EXPLAIN_ENABLED the query plan of each slow query shape is
+# captured once. The stats of at most MONGO_COMMAND_SHAPES shapes are kept.
+MONGO_SLOW_COMMAND = float(os.getenv("MONGO_SLOW_COMMAND", 0.1))
+MONGO_EXPLAIN_ENABLED = os.getenv("MONGO_EXPLAIN_ENABLED", "false").lower() == "true"
+MONGO_COMMAND_SHAPES = int(os.getenv("MONGO_COMMAND_SHAPES", 500))
+
+# Record request metrics, served at /metrics in the Prometheus text format to the
+# scrapers sending METRICS_TOKEN as a bearer token. Not served without a token.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_TOKEN = Secret(os.getenv("METRICS_TOKEN", ""))
+
+# Health probes: readiness is cached for HEALTH_CACHE_TTL seconds, pings mongo with a
+# HEALTH_PING_TIMEOUT deadline and fails once the event loop lags over HEALTH_MAX_LOOP_LAG
+HEALTH_CACHE_TTL = float(os.getenv("HEALTH_CACHE_TTL", 2))
+HEALTH_PING_TIMEOUT = float(os.getenv("HEALTH_PING_TIMEOUT", 1))
+HEALTH_MAX_LOOP_LAG = float(os.getenv("HEALTH_MAX_LOOP_LAG", 1))
+HEALTH_LOOP_LAG_INTERVAL = float(os.getenv("HEALTH_LOOP_LAG_INTERVAL", 0.5))
+HEALTH_OUTBOX_COUNT_LIMIT = int(os.getenv("HEALTH_OUTBOX_COUNT_LIMIT", 10000))
+
+# Blocking call detector, reporting the stack of the code holding the event loop
+# for longer than LOOP_WATCHDOG_THRESHOLD seconds. Diagnostic, off by default.
+LOOP_WATCHDOG_ENABLED = os.getenv("LOOP_WATCHDOG_ENABLED", "false").lower() == "true"
+LOOP_WATCHDOG_THRESHOLD = float(os.getenv("LOOP_WATCHDOG_THRESHOLD", 0.1))
+LOOP_WATCHDOG_REPORTS = int(os.getenv("LOOP_WATCHDOG_REPORTS", 100))
+LOOP_WATCHDOG_STACK_DEPTH = int(os.getenv("LOOP_WATCHDOG_STACK_DEPTH", 40))
+
+# Server-Timing header of the request phases, returned to admins only, and sampling profiles
+# of single requests asked by admins with the X-Profile header: PROFILER_MAX_ACTIVE requests at a time per
+# worker, sampled every PROFILER_INTERVAL seconds, the latest PROFILER_STORED being kept
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() == "true"
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "true").lower() == "true"
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", 0.005))
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", 30))
+PROFILER_MAX_ACTIVE = int(os.getenv("PROFILER_MAX_ACTIVE", 1))
+PROFILER_STORED = int(os.getenv("PROFILER_STORED", 20))
+
+# Verified credentials cache
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", 10000))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", 60))
+# Degraded mode: while the database is unavailable, keep accepting credentials verified
+# up to AUTH_DEGRADED_WINDOW seconds past their expiry. 0 disables it.
+AUTH_DEGRADED_WINDOW = float(os.getenv("AUTH_DEGRADED_WINDOW", 0))
+
+# Bloom filter of the registered emails, rejecting unknown emails without a database lookup.
+# It is sized for the larger of EMAIL_FILTER_CAPACITY and twice the number of users,
+# at EMAIL_FILTER_FP_RATE false positives: about 1.8MB for 1M emails at 0.1%.
+EMAIL_FILTER_ENABLED = os.getenv("EMAIL_FILTER_ENABLED", "true").lower() == "true"
+EMAIL_FILTER_CAPACITY = int(os.getenv("EMAIL_FILTER_CAPACITY", 1000000))
+EMAIL_FILTER_FP_RATE = float(os.getenv("EMAIL_FILTER_FP_RATE", 0.001))
+EMAIL_FILTER_REFRESH_INTERVAL = float(os.getenv("EMAIL_FILTER_REFRESH_INTERVAL", 30))
+
+# Cross worker cache invalidation, from a change stream of api_users or by polling
+# its updated_at field on standalone servers. The resume token of the change stream
+# is stored per CHANGE_WATCH_TOKEN_ID, every CHANGE_WATCH_TOKEN_INTERVAL seconds at most.
+CHANGE_WATCH_ENABLED = os.getenv("CHANGE_WATCH_ENABLED", "true").lower() == "true"
+CHANGE_WATCH_POLL_INTERVAL = float(os.getenv("CHANGE_WATCH_POLL_INTERVAL", 2))
+CHANGE_WATCH_TOKEN_INTERVAL = float(os.getenv("CHANGE_WATCH_TOKEN_INTERVAL", 5))
+CHANGE_WATCH_TOKEN_ID = os.getenv("CHANGE_WATCH_TOKEN_ID", socket.gethostname())
+
+# Default rate limit (requests per second), burst and daily quota of a user, 0 is unlimited.
+# Each user can override them with its rate_limit, rate_burst and daily_quota fields.
+RATE_LIMIT_DEFAULT = float(os.getenv("RATE_LIMIT_DEFAULT", 0))
+RATE_BURST_DEFAULT = int(os.getenv("RATE_BURST_DEFAULT", 20))
+DAILY_QUOTA_DEFAULT = int(os.getenv("DAILY_QUOTA_DEFAULT", 0))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", 10))
+
+# API key hashing scheme for new keys, "hmac" or "bcrypt".
+# bcrypt hashes of existing keys are upgraded when the key is next verified.
+API_KEY_HASH_SCHEME = os.getenv("API_KEY_HASH_SCHEME", "hmac")
+
+# API key hashing pool, "thread" or "process"
+HASH_POOL_KIND = os.getenv("HASH_POOL_KIND", "thread")
+HASH_POOL_SIZE = int(os.getenv("HASH_POOL_SIZE", os.cpu_count() or 1))
+HASH_POOL_QUEUE_DEPTH = int(os.getenv("HASH_POOL_QUEUE_DEPTH", 64))
+
+# User listing page sizes
+USER_LIST_PAGE_SIZE = int(os.getenv("USER_LIST_PAGE_SIZE", 100))
+USER_LIST_MAX_PAGE_SIZE = int(os.getenv("USER_LIST_MAX_PAGE_SIZE", 1000))
+USER_BULK_MAX_SIZE = int(os.getenv("USER_BULK_MAX_SIZE", 1000))
+USER_EXPORT_BATCH_SIZE = int(os.getenv("USER_EXPORT_BATCH_SIZE", 1000))
 
 # Sendgrid configuration
 SG_API = os.getenv(
@@ -25,3 +132,11 @@ SG_API = os.getenv(
     "")
 FROM_EMAIL = "noreply@email.com"
 
+# Email outbox, transport is "sendgrid" or "local"
+EMAIL_TRANSPORT = os.getenv("EMAIL_TRANSPORT", "sendgrid")
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv("EMAIL_OUTBOX_BATCH_SIZE", 50))
+EMAIL_OUTBOX_POLL_INTERVAL = float(os.getenv("EMAIL_OUTBOX_POLL_INTERVAL", 5))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv("EMAIL_OUTBOX_MAX_ATTEMPTS", 5))
+EMAIL_OUTBOX_BACKOFF = float(os.getenv("EMAIL_OUTBOX_BACKOFF", 30))
+EMAIL_OUTBOX_LEASE = float(os.getenv("EMAIL_OUTBOX_LEASE", 300))
+
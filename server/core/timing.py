@@ -0,0 +1,83 @@
+"""
+Server timing of the requests.
+The phases of a request (user lookup, key verification, route, rendering,
+compression) are recorded in the request context and returned to admins
+in a Server-Timing header, in milliseconds. The time the server takes to read
+the request, before the application is called, is not part of it.
+
+Admins can also ask for a sampling profile of a request with the X-Profile
+header: its id is returned in the X-Profile-Id header and the profile is
+served by the admin endpoints of the worker.
+"""
+import time
+
+from starlette.datastructures import MutableHeaders
+
+from server.core.context import Timings, current_route, current_timings
+from server.core.profiler import profiler
+from server.core.settings import SERVER_TIMING_ENABLED, PROFILER_ENABLED
+from server.models.user import User
+
+PROFILE_HEADER = b"x-profile"
+
+
+def trace_request(user: User):
+    """Return the timings of the request being served and profile the rest of it
+    if asked for, if the user is an admin
+    :param user: authenticated user of the request
+    """
+    timings = current_timings.get()
+    if timings is None or not (user.is_superuser or "admin" in user.endpoint_access):
+        return
+    timings.admin = True
+    if timings.profile_requested and timings.profile is None:
+        timings.profile = profiler.start(current_route.get())
+
+
+def server_timing(timings: Timings, compressed: bool) -> str:
+    now = time.perf_counter()
+    phases = dict(timings.phases)
+    if compressed and timings.response_ready is not None:
+        # the first chunk of the body is compressed before the headers are sent
+        phases["gzip"] = now - timings.response_ready
+    phases["total"] = now - timings.start
+    return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in phases.items())
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware returning the phase timings of the requests of admins in a Server-Timing
+    header, and running the profiles asked for. Outermost, so that the compression
+    of the response is timed too.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = Timings(
+            profile_requested=PROFILER_ENABLED
+            and any(name == PROFILE_HEADER for name, _ in scope["headers"])
+        )
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=message.setdefault("headers", []))
+                if SERVER_TIMING_ENABLED and timings.admin:
+                    headers.append("Server-Timing", server_timing(
+                        timings, headers.get("content-encoding") == "gzip"
+                    ))
+                if timings.profile is not None:
+                    headers.append("X-Profile-Id", timings.profile.id)
+            await send(message)
+
+        token = current_timings.set(timings)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_timings.reset(token)
+            if timings.profile is not None:
+                await profiler.stop(timings.profile)
@@ -0,0 +1,137 @@
+"""
+Blocking call detector.
+A task of the event loop beats every LOOP_WATCHDOG_THRESHOLD / 4 seconds
+while a thread watches the beats: once the loop is held for longer than
+LOOP_WATCHDOG_THRESHOLD, the thread captures the stack of the loop thread,
+i.e. the code holding the loop, along with the route being served. Reports
+are logged once the loop is released and the latest ones are kept for the
+admin endpoint.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+from server.core import context
+from server.core.context import task_routes
+from server.core.metrics import CallbackGauge
+from server.core.settings import (
+    LOOP_WATCHDOG_ENABLED,
+    LOOP_WATCHDOG_THRESHOLD,
+    LOOP_WATCHDOG_REPORTS,
+    LOOP_WATCHDOG_STACK_DEPTH
+)
+
+logger = logging.getLogger(__name__)
+
+# frames of this package, the innermost one is reported as the origin of a block
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+# frames of the route wrapper, never the origin
+CONTEXT_FILE = os.path.abspath(context.__file__)
+
+
+class LoopWatchdog:
+
+    def __init__(self, threshold: float = LOOP_WATCHDOG_THRESHOLD):
+        self.threshold = threshold
+        self.interval = threshold / 4
+        self.reports = deque(maxlen=LOOP_WATCHDOG_REPORTS)
+        self.blocked = 0
+        self.heartbeat = 0.0
+        self.pending: Optional[dict] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+
+    async def _beat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            self.heartbeat = expected
+            await asyncio.sleep(self.interval)
+            report = self.pending
+            if report is not None:
+                # the loop was released, the block is over
+                self.pending = None
+                report["duration"] = round(max(time.monotonic() - expected, 0.0), 6)
+                self.reports.append(report)
+                logger.warning(
+                    "Event loop blocked for %.3fs in %s (route %s)\n%s",
+                    report["duration"], report["origin"], report["route"] or "-",
+                    "".join(traceback.format_list(report["frames"]))
+                )
+
+    def _watch(self):
+        reported = None
+        while not self.stopping.wait(self.interval):
+            heartbeat = self.heartbeat
+            if heartbeat != reported and time.monotonic() - heartbeat > self.threshold:
+                reported = heartbeat
+                self._capture()
+
+    def _capture(self):
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is None:
+            return
+        frames = traceback.extract_stack(frame, limit=LOOP_WATCHDOG_STACK_DEPTH)
+        own_frames = [
+            summary for summary in frames
+            if summary.filename.startswith(PACKAGE_DIR) and summary.filename != CONTEXT_FILE
+        ]
+        origin = own_frames[-1] if own_frames else frames[-1]
+        task = asyncio.current_task(self.loop)
+        self.blocked += 1
+        self.pending = {
+            "at": datetime.utcnow().isoformat() + "Z",
+            "route": task_routes.get(task, ""),
+            "task": task.get_coro().__qualname__ if task is not None else "",
+            "origin": f"{origin.filename}:{origin.lineno} in {origin.name}",
+            "frames": frames,
+        }
+
+    def recent(self) -> list:
+        """The latest reports, most recent first
+        """
+        return [
+            {**report, "frames": [
+                f"{summary.filename}:{summary.lineno} in {summary.name}"
+                for summary in report["frames"]
+            ]}
+            for report in reversed(self.reports)
+        ]
+
+    def start(self):
+        if not LOOP_WATCHDOG_ENABLED:
+            return
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic() + self.interval
+        self.stopping.clear()
+        self.task = asyncio.ensure_future(self._beat())
+        self.thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    async def stop(self):
+        if self.task is not None:
+            self.stopping.set()
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            self.thread.join()
+            self.thread = None
+
+
+loop_watchdog = LoopWatchdog()
+
+CallbackGauge("event_loop_blocked_total", "Event loop blocks over the watchdog threshold",
+              lambda: loop_watchdog.blocked, kind="counter")
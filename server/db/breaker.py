@@ -0,0 +1,111 @@
+"""
+Circuit breaker of the database.
+Operations run with a deadline; after MONGO_BREAKER_FAILURES consecutive
+connection failures or timeouts the breaker opens and operations fail fast
+with a 503 for MONGO_BREAKER_RESET_TIMEOUT seconds. A single operation is
+then let through to probe the database, closing the breaker on success.
+"""
+import asyncio
+import logging
+import math
+import time
+
+from fastapi import HTTPException
+from pymongo.errors import ConnectionFailure, ExecutionTimeout
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
+
+from server.core.metrics import CallbackGauge
+from server.core.settings import (
+    MONGO_OPERATION_TIMEOUT,
+    MONGO_BREAKER_FAILURES,
+    MONGO_BREAKER_RESET_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+# errors of an unreachable or overloaded database, the others are answers of the database
+FAILURES = (ConnectionFailure, ExecutionTimeout, asyncio.TimeoutError)
+
+
+class DatabaseUnavailable(HTTPException):
+    def __init__(self, retry_after: float = MONGO_BREAKER_RESET_TIMEOUT):
+        super().__init__(
+            status_code=HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Database unavailable, try again later",
+            headers={"Retry-After": str(max(math.ceil(retry_after), 1))}
+        )
+
+
+class CircuitBreaker:
+
+    def __init__(
+            self,
+            timeout: float = MONGO_OPERATION_TIMEOUT,
+            max_failures: int = MONGO_BREAKER_FAILURES,
+            reset_timeout: float = MONGO_BREAKER_RESET_TIMEOUT
+    ):
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+
+    def _before_call(self):
+        if self.state == CLOSED:
+            return
+        retry_after = self.opened_at + self.reset_timeout - time.monotonic()
+        if self.state == OPEN and retry_after <= 0:
+            # let this call probe the database
+            self.state = HALF_OPEN
+            return
+        self.rejected += 1
+        raise DatabaseUnavailable(retry_after)
+
+    def _on_success(self):
+        if self.state != CLOSED:
+            logger.warning("Database is back, closing the circuit breaker")
+        self.state = CLOSED
+        self.failures = 0
+
+    def _on_failure(self, error: Exception):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.max_failures:
+            if self.state != OPEN:
+                logger.error("Opening the circuit breaker of the database after: %r", error)
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    async def call(self, func, *args, **kwargs):
+        """Run a database operation with a deadline, unless the breaker is open
+        :param func: motor method or coroutine function doing a single operation
+        :return: result of the operation
+        """
+        self._before_call()
+        try:
+            result = await asyncio.wait_for(func(*args, **kwargs), self.timeout)
+        except FAILURES as e:
+            self._on_failure(e)
+            raise DatabaseUnavailable(self.reset_timeout) from e
+        except asyncio.CancelledError:
+            if self.state == HALF_OPEN:
+                # the next call probes the database instead
+                self.state = OPEN
+            raise
+        except Exception:
+            # the database answered, with an error
+            self._on_success()
+            raise
+        self._on_success()
+        return result
+
+
+db_breaker = CircuitBreaker()
+
+CallbackGauge("mongo_breaker_open", "1 while the circuit breaker of the database is open",
+              lambda: int(db_breaker.state == OPEN))
+CallbackGauge("mongo_breaker_rejected_total", "Database operations rejected by the open breaker",
+              lambda: db_breaker.rejected, kind="counter")
@@ -2,43 +2,27 @@
 Helper functions
 """
 import secrets
-from typing import Optional
-from fastapi import Depends
+from typing import List, Optional
 
-from datetime import datetime
 from pydantic import EmailStr
 from starlette.exceptions import HTTPException
 from starlette.status import (
     HTTP_200_OK,
-    HTTP_401_UNAUTHORIZED,
     HTTP_204_NO_CONTENT,
     HTTP_422_UNPROCESSABLE_ENTITY,
 )
-from server.core.security import get_key_hash, generate_salt
-from server.db.mongodb import AsyncIOMotorClient, get_database
-from server.db.crud.user import get_user_by_email, update_api_user
-from server.models.user import BaseUserInDB, BaseUserUpdate
+from server.core.security import get_key_hash_async, generate_salt
+from server.db.mongodb import AsyncIOMotorClient
+from server.db.crud.user import (
+    get_user_by_email,
+    get_users_by_emails,
+    update_user_fields,
+    bulk_update_user_fields
+)
+from server.models.user import BaseUser, User
 from server.core.email.sendgrid import reset_email
 
 
-async def is_email_available(
-    db: AsyncIOMotorClient,
-    email: Optional[EmailStr] = None
-):
-    """Check to see if an email address is available in the database
-    :param db: AsyncIOMotorClient connection
-    :param email: email address to check
-    :return: user details if found or raise HTTPException
-    """
-    if email:
-        user_by_email = await get_user_by_email(db, email)
-        if user_by_email:
-            raise HTTPException(
-                status_code=HTTP_422_UNPROCESSABLE_ENTITY,
-                detail="User with this email already exists",
-            )
-
-
 async def reset_api(
         db: AsyncIOMotorClient,
         email: Optional[EmailStr] = None
@@ -49,9 +33,9 @@ async def reset_api(
     :return: raise HTTPExceptions appropriately
     """
     if email:
-        user: BaseUserUpdate = BaseUserUpdate(email=email)
+        # the endpoint is open to anyone: keys are only hashed for the users allowed a reset
         user_by_email = await get_user_by_email(db, email)
-        if user_by_email:
+        while user_by_email:
             if not user_by_email.is_active:
                 raise HTTPException(
                     status_code=HTTP_422_UNPROCESSABLE_ENTITY,
@@ -65,15 +49,24 @@ async def reset_api(
 
             new_salt = generate_salt()
             new_api_key = secrets.token_urlsafe(32)
-            user.salt = new_salt
-            user.hashed_api_key = get_key_hash(new_salt + new_api_key)
-            await update_api_user(db, email, user)
-            await reset_email(new_api_key, email)
-
-            raise HTTPException(
-                status_code=HTTP_200_OK,
-                detail=f"New API Key for {email} is {new_api_key}"
+            updated = await update_user_fields(
+                db, email,
+                {
+                    "salt": new_salt,
+                    "hashed_api_key": await get_key_hash_async(new_salt + new_api_key)
+                },
+                expected={"is_active": True, "disabled": False}
             )
+            if updated:
+                await reset_email(new_api_key, email)
+
+                raise HTTPException(
+                    status_code=HTTP_200_OK,
+                    detail=f"New API Key for {email} is {new_api_key}"
+                )
+
+            # changed meanwhile, check it again
+            user_by_email = await get_user_by_email(db, email)
 
     else:
         raise HTTPException(
@@ -92,8 +85,13 @@ async def verify_email(
     :return: raise HTTPExceptions appropriately
     """
     if email:
-        user: BaseUserUpdate = BaseUserUpdate(email=email)
+        updated = await update_user_fields(
+            db, email, {"is_active": True}, expected={"is_active": False, "disabled": False}
+        )
+        if updated:
+            return
 
+        # not updated, find out why
         user_by_email = await get_user_by_email(db, email)
         if user_by_email:
             if user_by_email.disabled:
@@ -108,10 +106,6 @@ async def verify_email(
                     status_code=HTTP_422_UNPROCESSABLE_ENTITY,
                     detail="Email is already verified and active"
                 )
-            else:
-                user.updated_at = datetime.utcnow()
-                user.is_active = True
-                await update_api_user(db, email, user)
         else:
             raise HTTPException(
                 status_code=HTTP_204_NO_CONTENT,
@@ -133,20 +127,15 @@ async def deactivate_email(
     :param email: email address to deactivate
     :return: raise HTTPExceptions appropriately
     """
-    user: BaseUserUpdate = BaseUserUpdate(email=email)
     if email:
-        user_by_email = await get_user_by_email(db, email)
-
-        if user_by_email:
-            if not user_by_email.disabled:
-                user.updated_at = datetime.utcnow()
-                user.disabled = True
-                await update_api_user(db, email, user)
-            else:
-                raise HTTPException(
-                    status_code=HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail="User already disabled!"
-                )
+        updated = await update_user_fields(
+            db, email, {"disabled": True}, expected={"disabled": False}
+        )
+        if not updated and await get_user_by_email(db, email):
+            raise HTTPException(
+                status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="User already disabled!"
+            )
     else:
         raise HTTPException(
             status_code=HTTP_204_NO_CONTENT,
@@ -163,22 +152,98 @@ async def activate_email(
     :param email: email address to activate
     :return: raise HTTPExceptions appropriately
     """
-    user: BaseUserUpdate = BaseUserUpdate(email=email)
     if email:
-        user_by_email = await get_user_by_email(db, email)
-
-        if user_by_email:
-            if user_by_email.disabled:
-                user.updated_at = datetime.utcnow()
-                user.disabled = False
-                await update_api_user(db, email, user)
-            else:
-                raise HTTPException(
-                    status_code=HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail="User already enabled!"
-                )
+        updated = await update_user_fields(
+            db, email, {"disabled": False}, expected={"disabled": True}
+        )
+        if not updated and await get_user_by_email(db, email):
+            raise HTTPException(
+                status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="User already enabled!"
+            )
     else:
         raise HTTPException(
             status_code=HTTP_204_NO_CONTENT,
             detail="No Email to validate"
         )
+
+
+# action: (changes, expected state, error when not in the expected state)
+bulk_actions = {
+    "disable": ({"disabled": True}, {"disabled": False}, "User already disabled!"),
+    "enable": ({"disabled": False}, {"disabled": True}, "User already enabled!"),
+    "verify": ({"is_active": True}, {"is_active": False}, "Email is already verified and active"),
+}
+
+
+def _bulk_error(
+        current_user: User,
+        email: EmailStr,
+        user: Optional[BaseUser],
+        action: str
+) -> Optional[str]:
+    """Why a user cannot be changed by a bulk action, if it cannot
+    """
+    _, expected, already_error = bulk_actions[action]
+    if action == "disable" and email == current_user.email:
+        return "Cannot disable own account!"
+    if user is None:
+        return "Unknown email id!"
+    if action != "verify" and user.is_superuser and not current_user.is_superuser:
+        # admin accounts cannot enable or disable superuser accounts
+        return "Current user does not have sufficient privileges."
+    if action == "verify" and user.disabled:
+        return "User is disabled. Cannot verify user email address"
+    if any(getattr(user, field) != value for field, value in expected.items()):
+        return already_error
+    return None
+
+
+async def bulk_change_status(
+        db: AsyncIOMotorClient,
+        current_user: User,
+        emails: List[EmailStr],
+        action: str
+) -> List[dict]:
+    """Disable, enable or verify many users at once, with the same rules as
+    deactivate_email, activate_email and verify_email
+    :param db: AsyncIOMotorClient connection
+    :param current_user: User doing the change
+    :param emails: email addresses to change
+    :param action: one of "disable", "enable" or "verify"
+    :return: list of the result of each email
+    """
+    changes, expected, _ = bulk_actions[action]
+    emails = list(dict.fromkeys(emails))
+    users = await get_users_by_emails(db, emails)
+
+    errors = {}
+    updates = []
+    for email in emails:
+        user = users.get(email)
+        error = _bulk_error(current_user, email, user, action)
+        if error:
+            errors[email] = error
+        else:
+            # guard on the state read above, so that concurrent changes are not lost
+            guard = {**expected, "is_superuser": user.is_superuser}
+            if action == "verify":
+                guard["disabled"] = False
+            updates.append((email, changes, guard))
+
+    updated = await bulk_update_user_fields(db, updates)
+    missed = [email for email, _, _ in updates if email not in updated]
+    if missed:
+        # changed concurrently, tell why from their current state
+        users = await get_users_by_emails(db, missed)
+        for email in missed:
+            errors[email] = (
+                _bulk_error(current_user, email, users.get(email), action)
+                or "User was changed meanwhile, try again"
+            )
+
+    return [
+        {"email": email, "status": "error", "detail": errors[email]} if email in errors
+        else {"email": email, "status": "updated"}
+        for email in emails
+    ]
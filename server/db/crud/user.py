@@ -1,39 +1,158 @@
 """
 CRUD Operations for User Endpoint
 """
-from typing import Optional
+from typing import Dict, List, Optional, Set, Tuple
 
+import asyncio
 import secrets
 from datetime import datetime
+from bson import ObjectId
+from bson.errors import InvalidId
 from pydantic import EmailStr
+from pymongo import ASCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from starlette.exceptions import HTTPException
+from starlette.status import HTTP_422_UNPROCESSABLE_ENTITY
 
-from server.db.mongodb import AsyncIOMotorClient
-from server.models.user import BaseUserCreate, BaseUserInDB, BaseUserUpdate
-from server.core.settings import mongo_db
+from server.core.bloom import email_filter
+from server.core.cache import SingleFlight, auth_cache
+from server.core.email.sendgrid import verification_email
+from server.core.metrics import CallbackGauge
+from server.db.breaker import db_breaker
+from server.db.mongodb import AsyncIOMotorClient, register_indexes
+from server.db.watcher import CollectionWatcher
+from server.models.user import BaseUser, BaseUserCreate, BaseUserInDB
+from server.core.settings import (
+    mongo_db,
+    USER_LIST_PAGE_SIZE,
+    USER_EXPORT_BATCH_SIZE,
+    HASH_POOL_SIZE
+)
 
 mongo_collection = "api_users"  # the collection for the user model
 
+register_indexes(
+    mongo_collection,
+    # every lookup and update is by email, which must also be unique
+    IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    # new users are picked up by the email filter of every worker
+    IndexModel([("created_at", ASCENDING)], name="created_at"),
+    # changes are polled on servers without change streams
+    IndexModel([("updated_at", ASCENDING)], name="updated_at"),
+)
 
-async def total_docs_in_db(conn: AsyncIOMotorClient) -> int:
+# fields which the cached credentials of a user depend on
+auth_fields = {
+    "salt", "hashed_api_key", "disabled", "is_active", "is_superuser", "endpoint_access",
+    "rate_limit", "rate_burst", "daily_quota"
+}
+
+# concurrent lookups of the same email share one query
+user_lookups = SingleFlight()
+
+CallbackGauge("user_lookups_coalesced_total", "User lookups served by a lookup in flight",
+              lambda: user_lookups.coalesced, kind="counter")
+
+# changes of the users made by any worker
+user_watcher = CollectionWatcher(mongo_collection)
+
+
+def _invalidate_user(operation: str, email: Optional[str]):
+    auth_cache.invalidate(email)
+    user_lookups.forget(email)
+    if email is not None:
+        email_filter.add(email)
+
+
+user_watcher.register(_invalidate_user)
+
+# fields returned when listing users, api key hashes and salts are never read
+user_list_projection = {field: 1 for field in BaseUser.__fields__}
+
+
+async def total_docs_in_db(conn: AsyncIOMotorClient, estimated: bool = False) -> int:
     """Get total documents in the database
     :param conn: AsyncIOMotorClient connection
+    :param estimated: use the collection metadata instead of counting the documents
     :return: INT count of the total docs in mongodb or 0 if none
     """
-    return await conn[mongo_db][mongo_collection].count_documents({})
+    if estimated:
+        return await db_breaker.call(conn[mongo_db][mongo_collection].estimated_document_count)
+    return await db_breaker.call(conn[mongo_db][mongo_collection].count_documents, {})
 
 
-async def get_all(conn: AsyncIOMotorClient) -> dict:
-    """Get all users and their information
+async def get_all(
+        conn: AsyncIOMotorClient,
+        limit: int = USER_LIST_PAGE_SIZE,
+        after: Optional[str] = None,
+        estimated_count: bool = False
+) -> dict:
+    """Get a page of users and their information, ordered by _id
     :param conn: AsyncIOMotorClient connection
-    :return: dict of all users
+    :param limit: max number of users in the page
+    :param after: cursor returned with the previous page, None for the first page
+    :param estimated_count: estimate the total number of users instead of counting them
+    :return: dict of the users in the page and the cursor of the next page
     """
-    total_docs = await total_docs_in_db(conn)
+    query = {}
+    if after:
+        try:
+            query["_id"] = {"$gt": ObjectId(after)}
+        except (InvalidId, TypeError):
+            raise HTTPException(
+                status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Invalid cursor"
+            )
+
+    total_docs = await total_docs_in_db(conn, estimated=estimated_count)
     docs = []
-    async for doc in conn[mongo_db][mongo_collection].find():
-        docs.append(BaseUserInDB(**doc).dict())
+    last_id = None
+    cursor = conn[mongo_db][mongo_collection].find(query, user_list_projection)
+    rows = await db_breaker.call(cursor.sort("_id", ASCENDING).limit(limit).to_list, limit)
+    for doc in rows:
+        last_id = doc["_id"]
+        docs.append(BaseUser.db_dict(doc))
 
-    if docs:
-        return {'total_users': total_docs, "users": docs}
+    return {
+        'total_users': total_docs,
+        "users": docs,
+        "next_cursor": str(last_id) if len(docs) == limit else None
+    }
+
+
+async def iter_users(
+        conn: AsyncIOMotorClient,
+        batch_size: int = USER_EXPORT_BATCH_SIZE
+):
+    """Iterate over all users, fetching them from the database in batches
+    :param conn: AsyncIOMotorClient connection
+    :param batch_size: number of users fetched per round trip
+    :return: async iterator of the projected user documents
+    """
+    cursor = conn[mongo_db][mongo_collection].find(
+        {}, {**user_list_projection, "_id": 0}, batch_size=batch_size
+    )
+    async for doc in cursor:
+        yield doc
+
+
+async def iter_emails(
+        conn: AsyncIOMotorClient,
+        created_since: Optional[datetime] = None,
+        batch_size: int = USER_EXPORT_BATCH_SIZE
+):
+    """Iterate over the emails of all users, or of the users created since a date
+    :param conn: AsyncIOMotorClient connection
+    :param created_since: only the users created at or after this date, None for all
+    :param batch_size: number of emails fetched per round trip
+    :return: async iterator of the emails
+    """
+    query = {} if created_since is None else {"created_at": {"$gte": created_since}}
+    cursor = conn[mongo_db][mongo_collection].find(
+        query, {"email": 1, "_id": 0}, batch_size=batch_size
+    )
+    async for doc in cursor:
+        yield doc["email"]
 
 
 async def get_user_by_email(
@@ -45,9 +164,54 @@ async def get_user_by_email(
     :param email: email of the user to fetch details
     :return: BaseUserInDB of a user found or None
     """
-    row = await conn[mongo_db][mongo_collection].find_one({"email": email})
+    return await user_lookups.do(email, _find_user_by_email, conn, email)
+
+
+async def _find_user_by_email(conn: AsyncIOMotorClient, email: EmailStr) -> BaseUserInDB:
+    row = await db_breaker.call(conn[mongo_db][mongo_collection].find_one, {"email": email})
     if row:
-        return BaseUserInDB(**row)
+        return BaseUserInDB.from_db(row)
+
+
+async def _new_api_user(
+        api_user: BaseUserCreate,
+        is_superuser: Optional[bool] = False,
+        endpoints: Optional[list] = None
+) -> Tuple[str, BaseUserInDB]:
+    """Build a new API user with a new API key, ready to be inserted
+    :return: tuple of the NEW API KEY and the BaseUserInDB to insert
+    """
+    api_key = secrets.token_urlsafe(32)
+
+    api_user = BaseUserInDB(**api_user.dict())
+    if is_superuser:
+        api_user.is_superuser = is_superuser
+
+    if endpoints:
+        api_user.endpoint_access += endpoints
+
+    await api_user.reset_api_key_async(api_key)
+    api_user.created_at = datetime.utcnow()
+    api_user.updated_at = datetime.utcnow()
+    return api_key, api_user
+
+
+async def get_users_by_emails(
+        conn: AsyncIOMotorClient,
+        emails: List[EmailStr]
+) -> Dict[str, BaseUser]:
+    """Get the public info of many users with a single query
+    :param conn: AsyncIOMotorClient connection
+    :param emails: emails of the users to fetch details
+    :return: dict of the BaseUser of the users found by email
+    """
+    users = {}
+    cursor = conn[mongo_db][mongo_collection].find(
+        {"email": {"$in": list(emails)}}, user_list_projection
+    )
+    for doc in await db_breaker.call(cursor.to_list, None):
+        users[doc["email"]] = BaseUser.from_db(doc)
+    return users
 
 
 async def create_api_user(
@@ -65,54 +229,141 @@ async def create_api_user(
     :param endpoints: Optional List value to provide which endpoints this user can have access (roles)
     :return: NEW API KEY as STR or None
     """
-    api_key = secrets.token_urlsafe(32)
+    api_key, api_user = await _new_api_user(api_user, is_superuser, endpoints)
+    try:
+        await db_breaker.call(conn[mongo_db][mongo_collection].insert_one, api_user.dict())
+    except DuplicateKeyError:
+        raise HTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="User with this email already exists",
+        )
 
-    api_user = BaseUserInDB(**api_user.dict())
-    if is_superuser:
-        api_user.is_superuser = is_superuser
-        
-    if endpoints:
-        api_user.endpoint_access += endpoints
+    email_filter.add(api_user.email)
+    user_lookups.forget(api_user.email)
+    return api_key
 
-    api_user.reset_api_key(api_key)
-    api_user.created_at = datetime.utcnow()
-    api_user.updated_at = datetime.utcnow()
-    row = await conn[mongo_db][mongo_collection].insert_one(api_user.dict())
 
-    return api_key
+async def create_api_users(
+        conn: AsyncIOMotorClient,
+        api_users: List[Tuple[BaseUserCreate, bool, Optional[list]]]
+) -> List[Optional[str]]:
+    """Create many New API Users with a single insert.
+    Existing users are skipped, the others are created regardless. On any other
+    write error, the users created are sent their verification email before raising.
+    :param conn: AsyncIOMotorClient connection
+    :param api_users: List of (BaseUserCreate model, is_superuser, endpoints) as for create_api_user
+    :return: List of the NEW API KEY of each user, None for the users that already exist
+    """
+    if not api_users:
+        return []
+
+    new_users = []
+    # the hash pool rejects the jobs beyond its capacity, hash a pool's worth at a time
+    for start in range(0, len(api_users), HASH_POOL_SIZE):
+        new_users += await asyncio.gather(*(
+            _new_api_user(api_user, is_superuser, endpoints)
+            for api_user, is_superuser, endpoints in api_users[start:start + HASH_POOL_SIZE]
+        ))
+    api_keys = [api_key for api_key, _ in new_users]
+    failure = None
+    try:
+        await db_breaker.call(
+            conn[mongo_db][mongo_collection].insert_many,
+            [api_user.dict() for _, api_user in new_users], ordered=False
+        )
+    except BulkWriteError as e:
+        for error in e.details["writeErrors"]:
+            if error["code"] != 11000:
+                # only duplicate emails are expected
+                failure = e
+            api_keys[error["index"]] = None
+
+    created = [
+        (api_key, api_user) for api_key, (_, api_user) in zip(api_keys, new_users)
+        if api_key is not None
+    ]
+    for _, api_user in created:
+        email_filter.add(api_user.email)
+        user_lookups.forget(api_user.email)
+    if failure is not None:
+        # the other users were inserted regardless, and this is the only copy of their key
+        await asyncio.gather(*(
+            verification_email(api_key, api_user.email) for api_key, api_user in created
+        ))
+        raise failure
+    return api_keys
 
 
-async def update_api_user(
+async def update_user_fields(
         conn: AsyncIOMotorClient,
         email: EmailStr,
-        user: BaseUserUpdate
-) -> BaseUserInDB:
-    """Update a user with new details
+        changes: dict,
+        expected: Optional[dict] = None
+) -> Optional[BaseUserInDB]:
+    """Atomically set some fields of a user, in a single round trip
     :param conn: AsyncIOMotorClient connection
-    :param email: email of the user to update details
-    :param user: BaseUserUpdate model
-    :return: BaseUserInDB of a user found or None
+    :param email: email of the user to update
+    :param changes: dict of the fields to set and their new values
+    :param expected: Optional dict of field values the user must have for the update to apply,
+    eg. {"disabled": False}
+    :return: BaseUserInDB of the updated user or None if no user matched
     """
-    api_user = await get_user_by_email(conn, email)
+    query = {**(expected or {}), "email": email}
+    row = await db_breaker.call(
+        conn[mongo_db][mongo_collection].find_one_and_update,
+        query,
+        {"$set": {**changes, "updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not row:
+        return None
 
-    api_user.salt = user.salt or api_user.salt
-    api_user.hashed_api_key = user.hashed_api_key or api_user.hashed_api_key
+    # lookups in flight may have read the user before the update
+    user_lookups.forget(email)
+    if auth_fields.intersection(changes):
+        # cached credentials of this user are no longer valid
+        auth_cache.invalidate(email)
 
-    api_user.endpoint_access = user.endpoint_access or api_user.endpoint_access
-    api_user.is_active = user.is_active or api_user.is_active
+    return BaseUserInDB.from_db(row)
 
-    if user.disabled is not None:
-        api_user.disabled = user.disabled
 
-    if user.is_active is not None:
-        api_user.is_active = user.is_active
+async def bulk_update_user_fields(
+        conn: AsyncIOMotorClient,
+        updates: List[Tuple[EmailStr, dict, Optional[dict]]]
+) -> Set[EmailStr]:
+    """Set some fields of many users with a single bulk write.
+    Each update is applied atomically, like update_user_fields.
+    :param conn: AsyncIOMotorClient connection
+    :param updates: List of (email, changes, expected) as for update_user_fields,
+    one per email
+    :return: set of the emails of the users updated, the others did not match
+    """
+    if not updates:
+        return set()
 
-    if user.is_superuser is not None:
-        api_user.is_superuser = user.is_superuser
+    # tags the users updated by this write, unlike updated_at which has a
+    # precision of a millisecond in mongo, shared with concurrent updates
+    operation = ObjectId()
+    updated_at = datetime.utcnow()
+    result = await db_breaker.call(conn[mongo_db][mongo_collection].bulk_write, [
+        UpdateOne(
+            {**(expected or {}), "email": email},
+            {"$set": {**changes, "updated_at": updated_at, "bulk_operation": operation}}
+        )
+        for email, changes, expected in updates
+    ], ordered=False)
 
-    api_user.updated_at = datetime.utcnow()
-    updated_at = await conn[mongo_db][mongo_collection].update_one(
-        {"email": api_user.email}, {'$set': api_user.dict()}
-    )
+    for email, changes, _ in updates:
+        user_lookups.forget(email)
+        if auth_fields.intersection(changes):
+            # cached credentials of this user are no longer valid
+            auth_cache.invalidate(email)
 
-    return api_user
+    if result.matched_count == len(updates):
+        return {email for email, _, _ in updates}
+    # the users updated are the ones still tagged by this write
+    cursor = conn[mongo_db][mongo_collection].find(
+        {"email": {"$in": [email for email, _, _ in updates]}, "bulk_operation": operation},
+        {"email": 1, "_id": 0}
+    )
+    return {doc["email"] for doc in await db_breaker.call(cursor.to_list, None)}
@@ -1,11 +1,35 @@
 """
 MongoDB
 """
+import asyncio
+import logging
+from typing import Optional
+
 from motor.motor_asyncio import AsyncIOMotorClient
-from server.core.settings import mongo_url, mongo_max_connections, mongo_min_connections
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure, PyMongoError
+from server.core.settings import (
+    mongo_db,
+    mongo_url,
+    mongo_max_connections,
+    mongo_min_connections,
+    MONGO_SERVER_SELECTION_TIMEOUT,
+    MONGO_CONNECT_TIMEOUT,
+    MONGO_SOCKET_TIMEOUT
+)
+from server.db.monitoring import command_listener, pool_listener
+
+logger = logging.getLogger(__name__)
+
+# index options compared against the declaration when verifying indexes
+INDEX_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
 
 class Database:
     client: AsyncIOMotorClient = None
+    indexes: dict = {}
+    # retrying ensure_indexes while mongo is unreachable
+    indexing: Optional[asyncio.Task] = None
 
 
 db = Database()
@@ -15,17 +39,112 @@ async def get_database() -> AsyncIOMotorClient:
     return db.client
 
 
+def register_indexes(collection: str, *indexes: IndexModel):
+    """Declare the indexes a collection needs, they are verified on connect
+    :param collection: name of the collection in mongo_db
+    :param indexes: pymongo IndexModel's of the collection
+    """
+    db.indexes.setdefault(collection, []).extend(indexes)
+
+
+def _diverging_options(current: dict, declared: dict) -> list:
+    diverging = []
+    if list(current["key"].items()) != list(declared["key"].items()):
+        diverging.append("key")
+    for option in INDEX_OPTIONS:
+        if current.get(option) != declared.get(option):
+            diverging.append(option)
+    return diverging
+
+
+async def ensure_indexes(client: AsyncIOMotorClient):
+    """Create the missing declared indexes and report the ones diverging
+    from their declaration. Existing indexes are never dropped.
+    :param client: AsyncIOMotorClient connection
+    """
+    for collection, indexes in db.indexes.items():
+        existing = {}
+        async for index in client[mongo_db][collection].list_indexes():
+            existing[index["name"]] = index
+
+        missing = []
+        for index in indexes:
+            declared = index.document
+            current = existing.get(declared["name"])
+            if current is None:
+                missing.append(index)
+                continue
+
+            diverging = _diverging_options(current, declared)
+            if diverging:
+                logger.warning(
+                    "Index %s.%s diverges from its declaration on: %s",
+                    collection, declared["name"], ", ".join(diverging)
+                )
+
+        if missing:
+            logger.warning(
+                "Creating missing indexes on %s: %s",
+                collection, ", ".join(index.document["name"] for index in missing)
+            )
+            try:
+                await client[mongo_db][collection].create_indexes(missing)
+            except OperationFailure as e:
+                # e.g. duplicate emails already in the way of a unique index
+                logger.error("Could not create indexes on %s: %s", collection, e)
+
+
+async def _ensure_indexes_when_reachable(client: AsyncIOMotorClient):
+    # the unique email index is the only guard against duplicate accounts
+    delay = 1
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            await client.admin.command("ping")
+        except PyMongoError:
+            delay = min(delay * 2, 30)
+            continue
+        try:
+            await ensure_indexes(client)
+        except PyMongoError as e:
+            logger.error("Could not verify the indexes: %s", e)
+            continue
+        logger.info("Reached mongo at %s, indexes verified", mongo_url)
+        db.indexing = None
+        return
+
+
 async def connect():
     """Connect to MONGO DB
     """
     db.client = AsyncIOMotorClient(str(mongo_url),
                                    maxPoolSize=mongo_max_connections,
-                                   minPoolSize=mongo_min_connections)
-    print(f"Connected to mongo at {mongo_url}")
+                                   minPoolSize=mongo_min_connections,
+                                   serverSelectionTimeoutMS=int(MONGO_SERVER_SELECTION_TIMEOUT * 1000),
+                                   connectTimeoutMS=int(MONGO_CONNECT_TIMEOUT * 1000),
+                                   socketTimeoutMS=int(MONGO_SOCKET_TIMEOUT * 1000),
+                                   event_listeners=[command_listener, pool_listener])
+    command_listener.attach(db.client)
+    try:
+        await db.client.admin.command("ping")
+    except PyMongoError as e:
+        # start anyway, requests fail fast until the database is reachable
+        logger.error("Could not reach mongo at %s: %s", mongo_url, e)
+        db.indexing = asyncio.ensure_future(_ensure_indexes_when_reachable(db.client))
+        return
+    logger.info("Connected to mongo at %s", mongo_url)
+    await ensure_indexes(db.client)
 
 
 async def close():
     """Close MongoDB Connection
     """
+    if db.indexing is not None:
+        db.indexing.cancel()
+        try:
+            await db.indexing
+        except asyncio.CancelledError:
+            pass
+        db.indexing = None
     db.client.close()
-    print("Closed connection with MongoDB")
+    logger.info("Closed connection with MongoDB")
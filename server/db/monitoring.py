@@ -0,0 +1,340 @@
+"""
+MongoDB command and connection pool monitoring.
+Commands are also aggregated in memory by query shape, i.e. by collection,
+command and filter with its values left out, for the admin endpoint.
+Commands slower than MONGO_SLOW_COMMAND are logged along with the route that
+ran them, and with MONGO_EXPLAIN_ENABLED the plan of each slow query shape
+is captured once by an explain run on the event loop.
+"""
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from pymongo import monitoring
+
+from server.core.context import current_route
+from server.core.metrics import MONGO_COMMAND_SECONDS, CallbackGauge
+from server.core.settings import (
+    MONGO_OPERATION_TIMEOUT,
+    MONGO_SLOW_COMMAND,
+    MONGO_EXPLAIN_ENABLED,
+    MONGO_COMMAND_SHAPES
+)
+
+logger = logging.getLogger(__name__)
+
+# filter of each command, by command name
+FILTERS = {
+    "find": "filter",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+    "update": "updates",
+    "delete": "deletes",
+    "aggregate": "pipeline",
+}
+# commands mongo explains, without running writes in the queryPlanner verbosity
+EXPLAINABLE = {"find", "count", "distinct", "findAndModify", "update", "delete", "aggregate"}
+# fields of the commands sent by the driver, not part of an explained command
+DRIVER_FIELDS = {"lsid", "txnNumber", "$clusterTime", "$db", "$readPreference", "writeConcern"}
+OTHER_SHAPES = "<other>"
+
+
+def _collection(command_name: str, command: dict) -> str:
+    if command_name == "getMore":
+        return command.get("collection", "")
+    target = command.get(command_name)
+    return target if isinstance(target, str) else ""
+
+
+def _skeleton(value) -> str:
+    # the structure of a filter, its values replaced by ?
+    if isinstance(value, dict):
+        return "{" + ", ".join(f"{key}: {_skeleton(item)}" for key, item in value.items()) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(dict.fromkeys(_skeleton(item) for item in value)) + "]"
+    return "?"
+
+
+def _shape(command_name: str, command: dict) -> str:
+    field = FILTERS.get(command_name)
+    if field is None:
+        return ""
+    target = command.get(field)
+    if command_name == "update":
+        target = [{"q": statement.get("q"), "multi": statement.get("multi", False)}
+                  for statement in target or ()]
+    elif command_name == "delete":
+        target = [statement.get("q") for statement in target or ()]
+    elif command_name == "aggregate":
+        # every stage in order by name, with the filter of $match and the order of $sort
+        return " | ".join(
+            f"$match {_skeleton(stage['$match'])}" if "$match" in stage
+            else f"$sort {dict(stage['$sort'])}" if "$sort" in stage
+            else ", ".join(stage)
+            for stage in target or ()
+        )
+    shape = _skeleton(target or {})
+    if command.get("sort"):
+        # the sort order decides of the index used, it is kept as is
+        shape += " sort " + str(dict(command["sort"]))
+    return shape
+
+
+def _plan(stage: dict) -> str:
+    name = stage.get("stage", "?")
+    if "indexName" in stage:
+        name += f"({stage['indexName']})"
+    children = [stage["inputStage"]] if "inputStage" in stage else stage.get("inputStages", [])
+    if children:
+        name += " <- " + ", ".join(_plan(child) for child in children)
+    return name
+
+
+def _winning_plan(explained: dict) -> dict:
+    planner = explained.get("queryPlanner")
+    if planner is None:
+        # aggregations of older servers explain their first stage
+        planner = explained["stages"][0]["$cursor"]["queryPlanner"]
+    plan = planner["winningPlan"]
+    return plan.get("queryPlan", plan)
+
+
+class ShapeStats:
+    __slots__ = ("collection", "command", "shape", "count", "failures", "total", "max",
+                 "slow", "last_slow_at", "last_route", "explain")
+
+    def __init__(self, collection: str, command: str, shape: str):
+        self.collection = collection
+        self.command = command
+        self.shape = shape
+        self.count = 0
+        self.failures = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.last_slow_at: Optional[str] = None
+        self.last_route = ""
+        self.explain: Optional[dict] = None
+
+    def summary(self) -> dict:
+        return {
+            "collection": self.collection,
+            "command": self.command,
+            "shape": self.shape,
+            "count": self.count,
+            "failures": self.failures,
+            "total": round(self.total, 6),
+            "mean": round(self.total / self.count, 6) if self.count else 0.0,
+            "max": round(self.max, 6),
+            "slow": self.slow,
+            "last_slow_at": self.last_slow_at,
+            "last_route": self.last_route,
+            "explain": self.explain,
+        }
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """Records the latency of every command by collection and command name,
+    and by query shape. Called synchronously by the driver from its threads,
+    so it only does bookkeeping: explains are scheduled on the event loop.
+    """
+
+    def __init__(self, slow: float = MONGO_SLOW_COMMAND, max_shapes: int = MONGO_COMMAND_SHAPES):
+        self.slow = slow
+        self.max_shapes = max_shapes
+        self.commands = {}
+        self.shapes = {}
+        self.lock = threading.Lock()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.client = None
+        self.explains = set()
+
+    def attach(self, client):
+        """Run the explains with the client, on the event loop running
+        :param client: AsyncIOMotorClient connection
+        """
+        self.client = client
+        self.loop = asyncio.get_event_loop()
+
+    def started(self, event):
+        collection = _collection(event.command_name, event.command)
+        explained = None
+        if MONGO_EXPLAIN_ENABLED and event.command_name in EXPLAINABLE:
+            explained = {
+                key: value for key, value in event.command.items() if key not in DRIVER_FIELDS
+            }
+        # motor >= 2.5 runs the driver calls in a copy of the context of the operation, with its route
+        self.commands[(event.connection_id, event.request_id)] = (
+            collection, _shape(event.command_name, event.command), current_route.get(),
+            event.database_name, explained
+        )
+
+    def _stats(self, collection: str, command_name: str, shape: str) -> ShapeStats:
+        key = (collection, command_name, shape)
+        stats = self.shapes.get(key)
+        if stats is None:
+            if len(self.shapes) >= self.max_shapes:
+                key = (collection, command_name, OTHER_SHAPES)
+                stats = self.shapes.get(key)
+            if stats is None:
+                stats = self.shapes[key] = ShapeStats(*key)
+        return stats
+
+    def _finished(self, event, outcome: str):
+        collection, shape, route, database, explained = self.commands.pop(
+            (event.connection_id, event.request_id), ("", "", "", "", None)
+        )
+        duration = event.duration_micros / 1e6
+        MONGO_COMMAND_SECONDS.labels(collection, event.command_name, outcome).observe(duration)
+
+        slow = duration >= self.slow
+        explain = False
+        with self.lock:
+            stats = self._stats(collection, event.command_name, shape)
+            stats.count += 1
+            stats.total += duration
+            stats.max = max(stats.max, duration)
+            if outcome != "success":
+                stats.failures += 1
+            if slow:
+                stats.slow += 1
+                stats.last_slow_at = datetime.utcnow().isoformat() + "Z"
+                stats.last_route = route
+                if explained is not None and stats.explain is None and self.loop is not None:
+                    explain = True
+                    stats.explain = {"status": "pending"}
+        if not slow:
+            return
+
+        logger.warning(
+            "Slow mongo %s on %s: %.1fms (route %s) %s",
+            event.command_name, collection or "-", duration * 1000, route or "-", shape
+        )
+        if explain:
+            self.loop.call_soon_threadsafe(self._schedule_explain, stats, database, explained)
+
+    def succeeded(self, event):
+        self._finished(event, "success")
+
+    def failed(self, event):
+        self._finished(event, "failure")
+
+    def _schedule_explain(self, stats: ShapeStats, database: str, command: dict):
+        task = asyncio.ensure_future(self._explain(stats, database, command))
+        self.explains.add(task)
+        task.add_done_callback(self.explains.discard)
+
+    async def _explain(self, stats: ShapeStats, database: str, command: dict):
+        started = time.perf_counter()
+        try:
+            explained = await asyncio.wait_for(
+                self.client[database].command({"explain": command, "verbosity": "queryPlanner"}),
+                MONGO_OPERATION_TIMEOUT
+            )
+            plan = _plan(_winning_plan(explained))
+        except Exception as e:
+            logger.warning("Explaining %s on %s failed: %r", stats.command, stats.collection, e)
+            stats.explain = {"status": "failed", "error": repr(e)}
+            return
+        stats.explain = {
+            "status": "done",
+            "at": datetime.utcnow().isoformat() + "Z",
+            "plan": plan,
+            "collscan": "COLLSCAN" in plan,
+            "seconds": round(time.perf_counter() - started, 6),
+        }
+        if stats.explain["collscan"]:
+            logger.warning(
+                "Slow mongo %s on %s scans the collection: %s %s",
+                stats.command, stats.collection, plan, stats.shape
+            )
+
+    def stats(self, limit: Optional[int] = None) -> list:
+        """Stats of the query shapes, the most time consuming first
+        :param limit: number of shapes returned, all by default
+        """
+        with self.lock:
+            shapes = sorted(self.shapes.values(), key=lambda stats: stats.total, reverse=True)
+            return [stats.summary() for stats in shapes[:limit]]
+
+
+command_listener = CommandMetricsListener()
+
+CallbackGauge("mongo_slow_commands_total", "Mongo commands slower than MONGO_SLOW_COMMAND",
+              lambda: sum(stats.slow for stats in list(command_listener.shapes.values())),
+              kind="counter")
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Keeps the connection counts of the pools of every server.
+    Called synchronously by the driver from any thread, so it only counts.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = 0           # connections created and not closed
+        self.checked_out = 0    # connections in use
+        self.waiting = 0        # check outs waiting for a connection
+        self.checkout_failures = 0
+        self.cleared = 0
+
+    def _add(self, **deltas):
+        with self.lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add(cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add(open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(open=-1)
+
+    def connection_check_out_started(self, event):
+        self._add(waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._add(waiting=-1, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._add(waiting=-1, checked_out=1)
+
+    def connection_checked_in(self, event):
+        self._add(checked_out=-1)
+
+    def stats(self) -> dict:
+        return {
+            "open": self.open,
+            "checked_out": self.checked_out,
+            "waiting": self.waiting,
+            "checkout_failures": self.checkout_failures,
+            "cleared": self.cleared,
+        }
+
+
+pool_listener = PoolStatsListener()
+
+CallbackGauge("mongo_pool_connections", "Open connections to mongo", lambda: pool_listener.open)
+CallbackGauge("mongo_pool_checked_out", "Mongo connections in use", lambda: pool_listener.checked_out)
+CallbackGauge("mongo_pool_waiting", "Operations waiting for a mongo connection",
+              lambda: pool_listener.waiting)
+CallbackGauge("mongo_pool_checkout_failures_total", "Failed mongo connection check outs",
+              lambda: pool_listener.checkout_failures, kind="counter")
@@ -0,0 +1,171 @@
+"""
+Change watcher, publishing the changes of a collection made by any worker
+to the local cache invalidators.
+Changes are read from a change stream, whose resume token is stored in
+the change_stream_tokens collection so that a restarted worker carries on
+where it stopped. Standalone servers have no change streams, the
+collection is then polled on its updated_at field instead.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from server.core.settings import (
+    mongo_db,
+    CHANGE_WATCH_ENABLED,
+    CHANGE_WATCH_POLL_INTERVAL,
+    CHANGE_WATCH_TOKEN_INTERVAL,
+    CHANGE_WATCH_TOKEN_ID
+)
+from server.db.mongodb import AsyncIOMotorClient, db
+
+logger = logging.getLogger(__name__)
+
+token_collection = "change_stream_tokens"
+
+# error codes of servers without change streams (standalone) and of lost resume tokens
+NO_CHANGE_STREAMS = {40573}
+HISTORY_LOST = {280, 286}
+
+# an invalidator is called with the operation (insert, update, replace, delete or
+# invalidate) and the email of the user, None when unknown meaning every user
+Invalidator = Callable[[str, Optional[str]], None]
+
+
+class CollectionWatcher:
+    """Watches the changes of a collection of users, whose documents have
+    an email and an updated_at field, and publishes them to the invalidators
+    """
+
+    def __init__(self, collection: str):
+        self.collection = collection
+        self.invalidators: List[Invalidator] = []
+        self.mode: Optional[str] = None  # "stream" or "poll"
+        self.events = 0
+        self.resume_token: Optional[dict] = None
+        self.task: Optional[asyncio.Task] = None
+        self._token_saved_at = 0.0
+
+    def register(self, invalidator: Invalidator):
+        """Register a local cache invalidator
+        :param invalidator: function(operation, email)
+        """
+        self.invalidators.append(invalidator)
+
+    def publish(self, operation: str, email: Optional[str]):
+        self.events += 1
+        for invalidator in self.invalidators:
+            try:
+                invalidator(operation, email)
+            except Exception:
+                logger.exception("Cache invalidator %r failed", invalidator)
+
+    @property
+    def token_id(self) -> str:
+        return f"{self.collection}@{CHANGE_WATCH_TOKEN_ID}"
+
+    async def _load_token(self, conn: AsyncIOMotorClient) -> Optional[dict]:
+        doc = await conn[mongo_db][token_collection].find_one({"_id": self.token_id})
+        return doc["token"] if doc else None
+
+    async def _save_token(self, conn: AsyncIOMotorClient, force: bool = False):
+        if self.resume_token is None:
+            return
+        if not force and time.monotonic() - self._token_saved_at < CHANGE_WATCH_TOKEN_INTERVAL:
+            return
+        self._token_saved_at = time.monotonic()
+        await conn[mongo_db][token_collection].update_one(
+            {"_id": self.token_id},
+            {"$set": {"token": self.resume_token, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    async def watch(self, conn: AsyncIOMotorClient):
+        """Publish the changes read from a change stream, until it fails
+        :param conn: AsyncIOMotorClient connection
+        """
+        self.mode = "stream"
+        pipeline = [{"$match": {"operationType": {
+            "$in": ["insert", "update", "replace", "delete", "invalidate"]
+        }}}]
+        stream = conn[mongo_db][self.collection].watch(
+            pipeline, full_document="updateLookup", resume_after=self.resume_token
+        )
+        async with stream:
+            async for change in stream:
+                operation = change["operationType"]
+                # deletes only carry the _id, and a lookup of an update may
+                # find the user already deleted: invalidate every user then
+                email = (change.get("fullDocument") or {}).get("email")
+                self.publish(operation, email)
+                self.resume_token = change["_id"]
+                if operation == "invalidate":
+                    self.resume_token = None
+                    return
+                await self._save_token(conn)
+
+    async def poll(self, conn: AsyncIOMotorClient):
+        """Publish the changes of the users updated since the last poll, forever
+        :param conn: AsyncIOMotorClient connection
+        """
+        self.mode = "poll"
+        since = datetime.utcnow()
+        while True:
+            await asyncio.sleep(CHANGE_WATCH_POLL_INTERVAL)
+            started = datetime.utcnow()
+            # overlap the previous poll to allow for clock skew between the workers
+            cursor = conn[mongo_db][self.collection].find(
+                {"updated_at": {"$gte": since - timedelta(seconds=CHANGE_WATCH_POLL_INTERVAL)}},
+                {"email": 1, "_id": 0}
+            )
+            async for doc in cursor:
+                self.publish("update", doc.get("email"))
+            since = started
+
+    async def run(self):
+        conn = db.client
+        try:
+            self.resume_token = await self._load_token(conn)
+        except PyMongoError:
+            logger.exception("Loading the resume token of %s failed", self.collection)
+
+        while True:
+            try:
+                await self.watch(conn)
+            except OperationFailure as e:
+                if e.code in NO_CHANGE_STREAMS:
+                    logger.info("No change streams on %s, polling it instead", self.collection)
+                    await self.poll(conn)
+                    return
+                if e.code in HISTORY_LOST:
+                    logger.warning("Changes of %s were lost, starting over", self.collection)
+                    self.resume_token = None
+                else:
+                    logger.exception("Watching %s failed", self.collection)
+            except PyMongoError:
+                logger.exception("Watching %s failed", self.collection)
+
+            # changes may have been missed meanwhile
+            self.publish("invalidate", None)
+            await asyncio.sleep(1)
+
+    def start(self):
+        if CHANGE_WATCH_ENABLED:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            try:
+                await self._save_token(db.client, force=True)
+            except PyMongoError:
+                logger.exception("Saving the resume token of %s failed", self.collection)
@@ -0,0 +1,66 @@
+"""
+Production server: uvicorn with SERVER_WORKERS worker processes, uvloop and httptools.
+On SIGTERM or SIGINT the workers stop accepting connections, let the requests in
+progress finish for up to SERVER_GRACEFUL_TIMEOUT seconds and run on_app_shutdown,
+which closes the Mongo pool.
+
+    python -m server.launcher
+"""
+import inspect
+import logging
+
+import uvicorn
+
+from server.core.settings import (
+    SERVER_HOST,
+    SERVER_PORT,
+    SERVER_WORKERS,
+    SERVER_LOOP,
+    SERVER_HTTP,
+    SERVER_BACKLOG,
+    SERVER_KEEPALIVE,
+    SERVER_GRACEFUL_TIMEOUT,
+    SERVER_LIMIT_CONCURRENCY,
+    SERVER_LOG_LEVEL,
+    SERVER_ACCESS_LOG,
+    SERVER_FORWARDED_ALLOW_IPS
+)
+
+logger = logging.getLogger(__name__)
+
+APP = "server.main:app"
+
+
+def server_options() -> dict:
+    """uvicorn options of the production server
+    """
+    options = {
+        "host": SERVER_HOST,
+        "port": SERVER_PORT,
+        "workers": SERVER_WORKERS,
+        "loop": SERVER_LOOP,
+        "http": SERVER_HTTP,
+        "backlog": SERVER_BACKLOG,
+        "timeout_keep_alive": SERVER_KEEPALIVE,
+        "limit_concurrency": SERVER_LIMIT_CONCURRENCY,
+        "log_level": SERVER_LOG_LEVEL,
+        "access_log": SERVER_ACCESS_LOG,
+        "proxy_headers": True,
+        "forwarded_allow_ips": SERVER_FORWARDED_ALLOW_IPS,
+        "lifespan": "on",
+        "reload": False,
+    }
+    # older uvicorn versions wait for the connections to close without a time limit
+    if "timeout_graceful_shutdown" in inspect.signature(uvicorn.Config).parameters:
+        options["timeout_graceful_shutdown"] = SERVER_GRACEFUL_TIMEOUT
+    else:
+        logger.warning("This uvicorn version has no graceful shutdown timeout")
+    return options
+
+
+def run():
+    uvicorn.run(APP, **server_options())
+
+
+if __name__ == "__main__":
+    run()
@@ -1,37 +1,78 @@
 """
 CDE v2
 """
-from fastapi import FastAPI
+import hmac
+
+from fastapi import FastAPI, Header
 
 from starlette.middleware.gzip import GZipMiddleware
-from starlette.requests import Request
+from starlette.exceptions import HTTPException
 from starlette.responses import Response
+from starlette.status import HTTP_401_UNAUTHORIZED
 
-from server.core.settings import default_route_str
+from server.core.settings import (
+    default_route_str,
+    METRICS_ENABLED,
+    METRICS_TOKEN,
+    SERVER_TIMING_ENABLED,
+    PROFILER_ENABLED
+)
+from server.core.metrics import MetricsMiddleware, render_metrics
+from server.core.responses import FastJSONResponse
+from server.core.timing import ServerTimingMiddleware
 from server.api import router as endpoint_router
-from server.db.mongodb import close, connect, AsyncIOMotorClient, get_database
+from server.api.endpoints.health import health_router
+from server.db.mongodb import close, connect
+from server.core.security import close_hash_pool
+from server.core.bloom import email_filter
+from server.core.context import ContextRoute
+from server.core.health import loop_monitor
+from server.core.watchdog import loop_watchdog
+from server.db.crud.user import user_watcher
+from server.core.email.outbox import outbox_worker
+from server.core.ratelimit import rate_limiter
 
 import uvicorn
 
 
-app = FastAPI(title="CDE v2", version="2")
+app = FastAPI(title="CDE v2", version="2", default_response_class=FastJSONResponse)
+app.router.route_class = ContextRoute
 app.add_middleware(GZipMiddleware, minimum_size=1000)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+if SERVER_TIMING_ENABLED or PROFILER_ENABLED:
+    # outermost
+    app.add_middleware(ServerTimingMiddleware)
 
 app.include_router(endpoint_router, prefix=default_route_str)
+app.include_router(health_router, prefix="/healthz")
 
 
 @app.on_event("startup")
 async def on_app_start():
     """Anything that needs to be done while app starts
     """
+    loop_monitor.start()
+    loop_watchdog.start()
     await connect()
+    await email_filter.start()
+    user_watcher.start()
+    outbox_worker.start()
+    rate_limiter.start()
 
 
 @app.on_event("shutdown")
 async def on_app_shutdown():
     """Anything that needs to be done while app shutdown
     """
+    await outbox_worker.stop()
+    await rate_limiter.stop()
+    await email_filter.stop()
+    await user_watcher.stop()
     await close()
+    close_hash_pool()
+    await loop_monitor.stop()
+    await loop_watchdog.stop()
 
 
 @app.get("/")
@@ -41,5 +82,17 @@ async def home():
     return Response("CDE v2")
 
 
+if METRICS_ENABLED and str(METRICS_TOKEN):
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics(authorization: str = Header(None)):
+        """Metrics in the Prometheus text format, for the scrapers sending the METRICS_TOKEN
+        """
+        if authorization is None or not hmac.compare_digest(
+                authorization.encode(), f"Bearer {METRICS_TOKEN}".encode()
+        ):
+            raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+        return Response(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     uvicorn.run(app, log_level="debug", reload=True)
@@ -1,11 +1,17 @@
 """
 DB Model
 """
+from copy import deepcopy
 from datetime import datetime, timezone
 from pydantic import BaseConfig, BaseModel, Schema, EmailStr
 from typing import Optional
 
-from server.core.security import verify_key, get_key_hash, generate_salt
+from server.core.security import (
+    verify_key,
+    get_key_hash,
+    get_key_hash_async,
+    generate_salt
+)
 
 
 class RWModel(BaseModel):
@@ -17,6 +23,36 @@ class RWModel(BaseModel):
             .replace("+00:00", "Z")
         }
 
+    @classmethod
+    def db_dict(cls, row: dict) -> dict:
+        """Get the fields of the model from a document of our own collections,
+        without validation, filling in the defaults of the missing fields
+        :param row: document as read from mongo
+        :return: dict of the field values of the model
+        """
+        values = {}
+        for name, field in cls.__fields__.items():
+            if name in row:
+                values[name] = row[name]
+            elif field.alias in row:
+                values[name] = row[field.alias]
+            else:
+                values[name] = deepcopy(field.default)
+        return values
+
+    @classmethod
+    def from_db(cls, row: dict):
+        """Build the model from a trusted document of our own collections,
+        skipping validation. Input from clients must be validated instead.
+        :param row: document as read from mongo
+        :return: instance of the model
+        """
+        # not construct(), whose signature differs between pydantic 0.x and 1.x
+        model = cls.__new__(cls)
+        object.__setattr__(model, "__dict__", cls.db_dict(row))
+        object.__setattr__(model, "__fields_set__", set(cls.__fields__).intersection(row))
+        return model
+
 
 class DateTimeModelMixin(BaseModel):
     created_at: Optional[datetime] = Schema(..., alias="createdAt")
@@ -31,7 +67,14 @@ class BaseUser(DateTimeModelMixin, RWModel):
     disabled: bool = False
 
 
-class BaseUserInDB(BaseUser):
+class RateLimitMixin(BaseModel):
+    # overrides of the default rate limits, internal to the server
+    rate_limit: Optional[float] = None
+    rate_burst: Optional[int] = None
+    daily_quota: Optional[int] = None
+
+
+class BaseUserInDB(RateLimitMixin, BaseUser):
     hashed_api_key: str = ""
     salt: str = ""
 
@@ -42,8 +85,12 @@ class BaseUserInDB(BaseUser):
         self.salt = generate_salt()
         self.hashed_api_key = get_key_hash(self.salt + api_key)
 
+    async def reset_api_key_async(self, api_key: str):
+        self.salt = generate_salt()
+        self.hashed_api_key = await get_key_hash_async(self.salt + api_key)
+
 
-class User(BaseUser):
+class User(RateLimitMixin, BaseUser):
     is_superuser: bool
     endpoint_access = list
 
@@ -52,12 +99,17 @@ class BaseUserCreate(RWModel):
     email: EmailStr
 
 
+class BaseUserBulkCreate(BaseUserCreate):
+    endpoint_access: list = []
+    is_superuser: bool = False
+
+
 class BaseUserLogin(RWModel):
     hashed_api_key: str
     email: EmailStr
 
 
-class BaseUserUpdate(BaseUser):
+class BaseUserUpdate(RateLimitMixin, BaseUser):
     hashed_api_key: Optional[str] = None
     salt: Optional[str] = None
     disabled: Optional[bool] = None